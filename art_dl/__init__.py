@@ -1,28 +1,38 @@
 import os.path
 from argparse import ArgumentParser
-from asyncio import create_task, new_event_loop, set_event_loop
+from asyncio import Task, create_task, gather, new_event_loop, set_event_loop
+from collections import defaultdict
 from typing import Optional, Tuple
 from urllib.parse import urlparse
 
+from art_dl.cache import cache
+from art_dl.ledger import ledger
 from art_dl.log import Logger, set_verbosity
-from art_dl.sites import download, register
+from art_dl.sites import canonical_key, download, merge, register
 from art_dl.utils.cleanup import cleanup
 from art_dl.utils.config import config
+from art_dl.utils.dispatch import dispatch
+from art_dl.utils.print import counter2str
 from art_dl.utils.retry import retry
 
 SLUGS_MAPPING = {
 	'artstation': ['www.artstation.com'],
 	'danbooru': ['danbooru.donmai.us', 'safebooru.donmai.us'],
 	'deviantart': ['www.deviantart.com'],
-	'imgur': ['imgur.com'],
-	'pixiv': ['www.pixiv.net', 'zettai.moe'],
-	'reddit': ['redd.it', 'www.reddit.com'],
+	'imgur': ['imgur.com', 'i.imgur.com'],
+	'pixiv': ['www.pixiv.net', 'zettai.moe', 'i.pximg.net'],
+	'reddit': ['redd.it', 'www.reddit.com', 'i.redd.it'],
 	'twitter': ['mobile.twitter.com', 'nitter.net', 'twitter.com'],
 	'wallhaven': ['wallhaven.cc', 'whvn.cc'],
 }
 
-SLUGS = { url: slug
-			for slug, urls in SLUGS_MAPPING.items() for url in urls }
+CONFIG_KEYS = ('cache_max_size', 'cache_memory_limit', 'download_limit', 'proxy', 'wallhaven_tags')
+
+SLUGS = {
+	url: slug
+	for slug, urls in SLUGS_MAPPING.items()
+	for url in urls
+}
 
 logger = Logger(prefix=['main'])
 
@@ -47,6 +57,17 @@ def parse_args():
 	)
 
 	parser.add_argument('--action', type=str, default=None)
+	parser.add_argument(
+		'--snapshot',
+		type=str,
+		help='Cache snapshot file for cache:export and cache:import actions'
+	)
+	parser.add_argument(
+		'--sites', type=str, help='Comma-separated sites to export or import, default - all sites'
+	)
+	parser.add_argument(
+		'--max-age', type=int, help='Export only entries updated in the last MAX_AGE days'
+	)
 
 	parser.add_argument('-q', '--quiet', action='store_true', help='Do not show logs')
 	parser.add_argument('-v', '--verbose', action='store_true', help='Show more logs')
@@ -64,27 +85,79 @@ async def process_list(urls: list[str], folder: str):
 		logger.info('no link')
 		return
 
-	mapping: dict[str, list[str]] = { s: []
-										for s in SLUGS.values() }
+	# { '<slug>': { '<canonical id>': ['url1', ...] } }
+	mapping: dict[str, dict[str, list[str]]] = {
+		s: defaultdict(list)
+		for s in SLUGS.values()
+	}
 	for u in urls:
 		site_slug = detect_site(u)
 		if site_slug is None:
 			logger.info('unknown link', u)
 			continue
 
-		mapping[site_slug].append(u)
+		# unsupported urls are passed as is, they are reported by site
+		mapping[site_slug][canonical_key(site_slug, u)].append(u)
 
-	logger.info('saving to', folder)
-	tasks = []
-	for slug, l in mapping.items():
-		if len(l) == 0:
-			continue
+	# urls waiting for site worker
+	queues: dict[str, list[str]] = defaultdict(list)
+	# canonical ids of all urls in this run
+	queued: dict[str, set[str]] = defaultdict(set)
+	workers: dict[str, Task] = {}
 
+	async def worker(slug: str):
 		save_folder = os.path.join(folder, slug)
-		tasks.append(create_task(download(slug)(l, save_folder)))
+		try:
+			# urls forwarded by other sites are downloaded by next batch
+			while len(queues[slug]) > 0:
+				l, queues[slug] = queues[slug], []
+				await download(slug)(l, save_folder)
+		finally:
+			del workers[slug]
+
+	async def enqueue(slug: str, grouped: dict[str, list[str]]):
+		merge_urls = merge(slug)
+		l = [merge_urls(g) for key, g in grouped.items() if key not in queued[slug]]
+		queued[slug].update(grouped.keys())
+		if (duplicates := sum(len(g) for g in grouped.values()) - len(l)) > 0:
+			logger.info('skip duplicates', slug + ':', duplicates)
+
+		not_completed = await ledger.filter_completed(slug, l)
+		if (completed := len(l) - len(not_completed)) > 0:
+			logger.info('skip completed', slug + ':', completed)
+		if len(not_completed) == 0:
+			return
+
+		queues[slug].extend(not_completed)
+		if slug not in workers:
+			workers[slug] = create_task(worker(slug))
+
+	async def forward(url: str) -> bool:
+		site_slug = detect_site(url)
+		if site_slug is None:
+			return False
+
+		logger.verbose('forward to', site_slug + ':', url)
+		await enqueue(site_slug, {
+			canonical_key(site_slug, url): [url]
+		})
+		return True
+
+	logger.info('saving to', folder)
+	dispatch.connect(forward)
+	try:
+		for slug, grouped in mapping.items():
+			if len(grouped) > 0:
+				await enqueue(slug, grouped)
 
-	for task in tasks:
-		await task
+		# workers can be started while waiting
+		while len(workers) > 0:
+			await gather(*workers.values())
+	finally:
+		dispatch.disconnect()
+		# save what was downloaded even if some site failed
+		await cache.aflush()
+		await ledger.flush()
 
 
 def prepare() -> Optional[Tuple[list[str], str]]:
@@ -121,8 +194,30 @@ def prepare() -> Optional[Tuple[list[str], str]]:
 	elif action == ('wallhaven', 'key'):
 		register('wallhaven')()
 		return None
-	elif action == ('config', 'proxy'):
-		config.input_entry('proxy')
+	elif action == ('cache', 'stats'):
+		cache.print_stats()
+		return None
+	elif action == ('cache', 'vacuum'):
+		cache.vacuum()
+		return None
+	elif action in (('cache', 'export'), ('cache', 'import')):
+		if args.snapshot is None:
+			logger.info('specify snapshot file with --snapshot')
+			return None
+		sites = args.sites.split(',') if args.sites else None
+		if action[1] == 'export':
+			cache.export(args.snapshot, sites, args.max_age)
+		else:
+			cache.import_(args.snapshot, sites)
+		return None
+	elif action == ('downloads', 'verify'):
+		ledger.verify()
+		return None
+	elif action is not None and len(action) == 2 and action[0] == 'config':
+		if action[1] not in CONFIG_KEYS:
+			logger.info('unknown config key:', action[1])
+			return None
+		config.input_entry(action[1])
 		return None
 	elif action is not None:
 		logger.info('unknown action:', args.action)
@@ -155,6 +250,7 @@ def _real_main():
 		run(to_retry, folder)
 
 	retry.clear(force=True)
+	logger.verbose('memory cache:', counter2str(cache.memory.stats()))
 
 
 def main():
@@ -164,6 +260,8 @@ def main():
 	except KeyboardInterrupt:
 		logger.configure(inline=True)
 		logger.warn('interrupted by user, exiting')
+	cache.flush()
+	ledger.flush_sync()
 	cleanup.clean()
 
 
@@ -1,28 +1,364 @@
-from typing import Any
+import os.path
+import sqlite3 as sql
+from asyncio import Task, create_task, gather
+from collections import Counter, defaultdict
+from functools import partial
+from time import time
+from typing import Any, Awaitable, Callable, Mapping
 
-from art_dl.utils.db import DB
+from art_dl.log import Logger
+from art_dl.utils import codec
+from art_dl.utils.config import config
+from art_dl.utils.db import DB, AsyncDB
 from art_dl.utils.dirs import DIRS
+from art_dl.utils.lru import LRU
+from art_dl.utils.print import format_size
+from art_dl.utils.singleflight import flight
 
 CACHE_DB = DIRS.cache + '/cache.db'
+# in MiB, can be changed with "--action config:cache_memory_limit"
+DEFAULT_MEMORY_LIMIT = 64
+# in MiB, can be changed with "--action config:cache_max_size"
+DEFAULT_MAX_SIZE = 1024
+# check database size after this number of inserts
+SIZE_CHECK_INTERVAL = 1000
+# write accessed_at after this number of accessed keys
+TOUCH_BATCH = 512
+
+DAY = 24 * 60 * 60
+# entries of these sites are refreshed after given time,
+# entries of other sites never expire
+TTL = {
+	'artstation': 7 * DAY,
+	'imgur': 30 * DAY,
+	'pixiv': 30 * DAY,
+}
+
+_MISSING = object()
+
+logger = Logger(prefix=['cache'])
+
+
+def _mib_config(key: str, default: int) -> int:
+	value = config.get(key)
+	try:
+		return int(value or default) * 1024 * 1024
+	except ValueError:
+		return default * 1024 * 1024
 
 
 class Cache:
+	"""
+	Two-tier cache: decoded values are kept in memory (LRU),
+	all writes go through to sqlite.
+
+	Use `a*` methods inside event loop, they run sqlite queries in separate thread
+	"""
 
 	def __init__(self) -> None:
 		self.db = DB(CACHE_DB, 'cache')
+		self.adb = AsyncDB(self.db)
+		self.stats_db = DB(CACHE_DB, 'cache_stats')
+		self.memory = LRU(_mib_config('cache_memory_limit', DEFAULT_MEMORY_LIMIT))
+		self.max_size = _mib_config('cache_max_size', DEFAULT_MAX_SIZE)
+
+		# { '<slug>': Counter(hit=1, miss=2, stale=3) } for current run
+		self.stats: defaultdict[str, Counter] = defaultdict(Counter)
+		self._touched: set[str] = set()
+		# values of old format, re-encoded on access
+		self._migrated: dict[str, bytes] = {}
+		self._inserts = 0
+		self._revalidating: dict[str, Task] = {}
 
 	@staticmethod
 	def _key(slug: str | None, key: str):
 		return key if slug is None else slug + ':' + key
 
+	@staticmethod
+	def is_stale(slug: str | None, updated_at: int | None) -> bool:
+		if (ttl := TTL.get(slug or '')) is None:
+			return False
+		return updated_at is None or updated_at + ttl < time()
+
+	def _count(self, slug: str | None, name: str):
+		if slug is not None:
+			self.stats[slug].update({
+				name: 1
+			})
+
+	def _touch(self, full_key: str):
+		self._touched.add(full_key)
+
+	def _take_pending(self) -> tuple[list[str], dict[str, bytes]]:
+		touched, migrated = list(self._touched), self._migrated
+		self._touched, self._migrated = set(), {}
+		return touched, migrated
+
+	def _write_pending(self, touched: list[str], migrated: dict[str, bytes]):
+		""" Write accessed_at and re-encoded values, can be called from db thread """
+		if len(touched) > 0:
+			self.db.touch(touched)
+		if len(migrated) > 0:
+			self.db.update(migrated)
+
+	def _flush_pending(self):
+		self._write_pending(*self._take_pending())
+
+	@staticmethod
+	def _encode(value: str | Any, as_json: bool) -> tuple[str | bytes, int]:
+		""" Returns encoded value and its size in memory """
+		if not as_json:
+			return value, len(value)
+		raw = codec.encode(value)
+		return raw, codec.decoded_size(raw)
+
+	def _from_memory(self, slug: str | None, full_key: str, as_json: bool):
+		if (item := self.memory.get((full_key, as_json), _MISSING)) is not _MISSING:
+			self._count(slug, 'hit')
+			self._touch(full_key)
+		return item
+
+	def _from_row(self, slug: str | None, full_key: str, as_json: bool,
+					row) -> tuple[Any, int | None]:
+		""" Decode value selected from db, returns value with its `updated_at` """
+		if row is None:
+			self._count(slug, 'miss')
+			return None, None
+
+		raw, updated_at = row['value'], row['updated_at']
+		if as_json:
+			value = codec.decode(raw)
+			if codec.is_legacy(raw):
+				self._migrated[full_key] = codec.encode(value)
+			size = codec.decoded_size(raw)
+		else:
+			value, size = raw, len(raw)
+		self.memory.set((full_key, as_json), (value, updated_at), size)
+
+		self._count(slug, 'hit')
+		self._touch(full_key)
+		return value, updated_at
+
+	def _lookup(self, slug: str | None, key: str, as_json: bool) -> tuple[Any, int | None]:
+		full_key = self._key(slug, key)
+		if (item := self._from_memory(slug, full_key, as_json)) is not _MISSING:
+			return item
+
+		row: sql.Row | dict | None
+		is_pending, row = self.adb.pending_row(full_key)
+		if not is_pending:
+			row = self.db.select_row(full_key)
+		result = self._from_row(slug, full_key, as_json, row)
+
+		if len(self._touched) >= TOUCH_BATCH:
+			self._flush_pending()
+		return result
+
+	async def _alookup(self, slug: str | None, key: str, as_json: bool) -> tuple[Any, int | None]:
+		full_key = self._key(slug, key)
+		if (item := self._from_memory(slug, full_key, as_json)) is not _MISSING:
+			return item
+
+		row = await self.adb.select_row(full_key)
+		result = self._from_row(slug, full_key, as_json, row)
+
+		if len(self._touched) >= TOUCH_BATCH:
+			self.adb.submit(self._write_pending, *self._take_pending())
+		return result
+
+	def _inserted(self, full_key: str, value: str | Any, as_json: bool, size: int) -> bool:
+		""" Update memory after insert, returns `True` when database size should be checked """
+		self._migrated.pop(full_key, None)
+		self.memory.set((full_key, as_json), (value, int(time())), size)
+
+		self._inserts += 1
+		return self._inserts % SIZE_CHECK_INTERVAL == 0
+
 	def insert(self, slug: str | None, key: str, value: str | Any, *, as_json=False):
-		self.db.insert(self._key(slug, key), value, as_json=as_json)
+		full_key = self._key(slug, key)
+		raw, size = self._encode(value, as_json)
+		# otherwise queued value will overwrite this one
+		self.adb.flush_sync()
+		self.db.insert(full_key, raw, replace=True)
+
+		if self._inserted(full_key, value, as_json, size):
+			self.shrink()
+
+	async def ainsert(self, slug: str | None, key: str, value: str | Any, *, as_json=False):
+		""" Value is saved to memory immediately, write to database is queued """
+		full_key = self._key(slug, key)
+		raw, size = self._encode(value, as_json)
+		self.adb.insert(full_key, raw)
+
+		if self._inserted(full_key, value, as_json, size):
+			self.adb.submit(self._shrink_db)
+
+	async def ainsert_many(self, slug: str | None, values: Mapping[str, Any], *, as_json=False):
+		""" Like `ainsert`, values are written to database in one transaction """
+		check_size = False
+		for key, value in values.items():
+			full_key = self._key(slug, key)
+			raw, size = self._encode(value, as_json)
+			self.adb.insert(full_key, raw)
+			check_size = self._inserted(full_key, value, as_json, size) or check_size
+
+		if check_size:
+			self.adb.submit(self._shrink_db)
 
 	def select(self, slug: str | None, key: str, *, as_json=False):
-		return self.db.select(self._key(slug, key), as_json=as_json)
+		""" Stale values are also returned, use `fetch` to refresh them """
+		return self._lookup(slug, key, as_json)[0]
+
+	async def aselect(self, slug: str | None, key: str, *, as_json=False):
+		""" Stale values are also returned, use `fetch` to refresh them """
+		return (await self._alookup(slug, key, as_json))[0]
+
+	def _forget(self, full_key: str):
+		self.memory.pop((full_key, True))
+		self.memory.pop((full_key, False))
+		self._migrated.pop(full_key, None)
 
 	def delete(self, slug: str | None, key: str):
-		self.db.delete(self._key(slug, key))
+		full_key = self._key(slug, key)
+		self._forget(full_key)
+		self.adb.flush_sync()
+		self.db.delete(full_key)
+
+	async def adelete(self, slug: str | None, key: str):
+		full_key = self._key(slug, key)
+		self._forget(full_key)
+		self.adb.delete(full_key)
+
+	async def fetch(
+		self,
+		slug: str,
+		key: str,
+		fetcher: Callable[[], Awaitable[Any]],
+		*,
+		cacheable: Callable[[Any], bool] = lambda v: v is not None,
+	):
+		"""
+		Get json value from cache or from `fetcher`. Stale value is returned
+		immediately and refreshed in background, wait for it with `revalidated()`
+		"""
+		value, updated_at = await self._alookup(slug, key, True)
+		full_key = self._key(slug, key)
+		if value is None:
+			# concurrent misses of the same key wait for one request
+			return await flight.do(full_key, partial(self._fetch, slug, key, fetcher, cacheable))
+
+		if self.is_stale(slug, updated_at) and full_key not in self._revalidating:
+			self._count(slug, 'stale')
+			task = create_task(self._revalidate(slug, key, fetcher, cacheable))
+			self._revalidating[full_key] = task
+			task.add_done_callback(lambda _: self._revalidating.pop(full_key, None))
+
+		return value
+
+	async def _fetch(
+		self,
+		slug: str,
+		key: str,
+		fetcher: Callable[[], Awaitable[Any]],
+		cacheable: Callable[[Any], bool],
+	):
+		value = await fetcher()
+		if cacheable(value):
+			await self.ainsert(slug, key, value, as_json=True)
+		return value
+
+	async def _revalidate(
+		self,
+		slug: str,
+		key: str,
+		fetcher: Callable[[], Awaitable[Any]],
+		cacheable: Callable[[Any], bool],
+	):
+		try:
+			value = await fetcher()
+		except Exception as e:
+			# stale value is already used, so just try next time
+			logger.verbose('failed to refresh', self._key(slug, key) + ':', e)
+			return
+
+		if cacheable(value):
+			await self.ainsert(slug, key, value, as_json=True)
+
+	async def revalidated(self):
+		""" Wait until stale values are refreshed """
+		while len(self._revalidating) > 0:
+			await gather(*self._revalidating.values())
+
+	def _shrink_db(self) -> int:
+		""" Evict least recently accessed entries if database is bigger than max size """
+		size = self.db.size()
+		if size <= self.max_size:
+			return 0
+
+		# size of freed pages is not known, so evict proportionally
+		count = self.db.count()
+		return self.db.evict(count * (size - self.max_size) // size + 1)
+
+	def shrink(self) -> int:
+		self.adb.flush_sync()
+		self._flush_pending()
+		if (evicted := self._shrink_db()) > 0:
+			self.memory.clear()
+		return evicted
+
+	async def aflush(self):
+		""" Wait until all queued writes are saved """
+		self.adb.submit(self._write_pending, *self._take_pending())
+		await self.adb.flush()
+
+	def flush(self):
+		""" Save queued writes, accessed_at and hit rate statistics """
+		self.adb.flush_sync()
+		self._flush_pending()
+		for slug, counter in self.stats.items():
+			saved = self.stats_db.select(slug, as_json=True) or {}
+			counter.update(saved)
+			self.stats_db.insert(slug, dict(counter), as_json=True, replace=True)
+		self.stats.clear()
+
+	def print_stats(self):
+		self.flush()
+		for row in self.db.stats():
+			counter = Counter(self.stats_db.select(row['site'], as_json=True) or {})
+			requests = counter['hit'] + counter['miss']
+			hit_rate = counter['hit'] / requests * 100 if requests > 0 else 0
+			logger.info(
+				row['site'] + ':',
+				f"entries: {row['entries']},",
+				f"size: {format_size(row['size'] or 0)},",
+				f"hits: {counter['hit']}, misses: {counter['miss']}, stale: {counter['stale']},",
+				f'hit rate: {hit_rate:.1f}%',
+			)
+		logger.info('database size:', format_size(self.db.size()))
+
+	def vacuum(self):
+		evicted = self.shrink()
+		self.db.vacuum()
+		logger.info('evicted:', evicted)
+		self.print_stats()
+
+	def export(self, filename: str, sites: list[str] | None = None, max_age: int | None = None):
+		""" Save entries updated in last `max_age` days to snapshot """
+		self.flush()
+		since = int(time()) - max_age * DAY if max_age is not None else None
+		exported = self.db.export(filename, sites, since)
+		logger.info('exported:', exported, 'to', filename)
+
+	def import_(self, filename: str, sites: list[str] | None = None):
+		""" Merge entries from snapshot, newer entries are kept """
+		if not os.path.exists(filename):
+			logger.warn('snapshot not found:', filename)
+			return
+
+		self.flush()
+		imported = self.db.merge(filename, sites)
+		self.memory.clear()
+		logger.info('imported:', imported, 'from', filename)
 
 
 cache = Cache()
@@ -0,0 +1,280 @@
+"""
+Ledger of completed downloads, it's checked before any network or filesystem work.
+
+Urls which are downloaded completely are also saved, they are checked with
+bloom filter first, so most of not downloaded urls do not need a query
+"""
+
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from time import time
+from typing import Iterator
+
+from art_dl.log import Logger
+from art_dl.sites import completed_key
+from art_dl.utils.bloom import BloomFilter
+from art_dl.utils.db import AsyncDB, Connection
+from art_dl.utils.dirs import DIRS
+from art_dl.utils.file_index import file_index
+from art_dl.utils.retry import retry
+
+LEDGER_DB = DIRS.cache + '/ledger.db'
+SEEN_FILTER = DIRS.cache + '/seen.bloom'
+# with these values filter takes ~12 MiB
+SEEN_CAPACITY = 10_000_000
+SEEN_ERROR_RATE = 0.01
+# number of keys in one query
+QUERY_CHUNK = 500
+VERIFY_WORKERS = 16
+VERIFY_CHUNK = 10000
+
+Record = namedtuple(
+	'Record', ['site', 'site_id', 'source', 'url', 'path', 'size', 'hash', 'created_at']
+)
+Completed = namedtuple('Completed', ['key', 'created_at'])
+
+logger = Logger(prefix=['ledger'])
+
+
+class Queries:
+	init = '''CREATE TABLE IF NOT EXISTS downloads (
+		site TEXT NOT NULL,
+		site_id TEXT NOT NULL,
+		source TEXT,
+		url TEXT,
+		path TEXT NOT NULL,
+		size INTEGER,
+		hash TEXT,
+		created_at INTEGER,
+		PRIMARY KEY (site, site_id)
+	);
+	CREATE TABLE IF NOT EXISTS completed (
+		key TEXT NOT NULL PRIMARY KEY,
+		created_at INTEGER
+	)'''
+	select = '''SELECT 1 FROM downloads WHERE site = :site AND site_id = :site_id'''
+	select_many = '''SELECT site_id FROM downloads WHERE site = ? AND site_id IN ({ids})'''
+	insert = '''INSERT OR REPLACE INTO downloads
+		(site, site_id, source, url, path, size, hash, created_at)
+		VALUES (:site, :site_id, :source, :url, :path, :size, :hash, :created_at)'''
+	delete = '''DELETE FROM downloads WHERE site = :site AND site_id = :site_id'''
+	all = '''SELECT * FROM downloads'''
+	complete = '''INSERT OR IGNORE INTO completed (key, created_at) VALUES (:key, :created_at)'''
+	select_completed = '''SELECT key FROM completed WHERE key IN ({keys})'''
+	all_completed = '''SELECT key FROM completed'''
+	uncomplete = '''DELETE FROM completed WHERE key = :key'''
+
+
+class LedgerDB(Connection):
+
+	def __init__(self, db_name: str) -> None:
+		super().__init__(db_name)
+		self.conn.execute('PRAGMA journal_mode = WAL')
+		self.cursor.executescript(Queries.init)
+		self.conn.commit()
+
+	def has(self, site: str, site_id: str) -> bool:
+		return self.cursor.execute(Queries.select, {
+			'site': site,
+			'site_id': site_id,
+		}).fetchone() is not None
+
+	def has_many(self, site: str, site_ids: list[str]) -> set[str]:
+		""" Select recorded ids """
+		result: set[str] = set()
+		for i in range(0, len(site_ids), QUERY_CHUNK):
+			chunk = site_ids[i:i + QUERY_CHUNK]
+			query = Queries.select_many.format(ids=', '.join('?' * len(chunk)))
+			result.update(r['site_id'] for r in self.cursor.execute(query, [site, *chunk]))
+		return result
+
+	def write_many(self, writes: dict[tuple, Record | Completed | None]):
+		""" Save records in one transaction, `None` record means delete """
+		self.cursor.executemany(
+			Queries.insert, (r._asdict() for r in writes.values() if isinstance(r, Record))
+		)
+		self.cursor.executemany(
+			Queries.complete, (r._asdict() for r in writes.values() if isinstance(r, Completed))
+		)
+		self.cursor.executemany(
+			Queries.delete, ({
+				'site': site,
+				'site_id': site_id,
+			} for (site, site_id), r in writes.items() if r is None)
+		)
+		self.conn.commit()
+
+	def completed(self, keys: list[str]) -> set[str]:
+		""" Select keys of completed urls """
+		result: set[str] = set()
+		for i in range(0, len(keys), QUERY_CHUNK):
+			chunk = keys[i:i + QUERY_CHUNK]
+			query = Queries.select_completed.format(keys=', '.join('?' * len(chunk)))
+			result.update(r['key'] for r in self.cursor.execute(query, chunk))
+		return result
+
+	def uncomplete(self, keys: list[str]):
+		self.cursor.executemany(Queries.uncomplete, ({
+			'key': k
+		} for k in keys))
+		self.conn.commit()
+
+	def all_completed(self) -> Iterator[str]:
+		for row in self.conn.execute(Queries.all_completed):
+			yield row['key']
+
+	def records(self) -> Iterator[list[Record]]:
+		""" Iterate over all records by chunks """
+		cursor = self.conn.execute(Queries.all)
+		while len(rows := cursor.fetchmany(VERIFY_CHUNK)) > 0:
+			yield [Record(**r) for r in rows]
+
+
+def _is_valid(record: Record) -> bool:
+	try:
+		return os.stat(record.path).st_size == record.size
+	except FileNotFoundError:
+		return False
+
+
+class Ledger:
+	""" Database and filter are opened on first use, most actions don't need them """
+
+	@cached_property
+	def db(self) -> LedgerDB:
+		return LedgerDB(LEDGER_DB)
+
+	@cached_property
+	def adb(self) -> AsyncDB:
+		return AsyncDB(self.db)
+
+	@cached_property
+	def seen(self) -> BloomFilter:
+		seen = BloomFilter(SEEN_FILTER, SEEN_CAPACITY, SEEN_ERROR_RATE)
+		if seen.created:
+			# filter was removed or its parameters were changed
+			for key in self.db.all_completed():
+				seen.add(key)
+		return seen
+
+	def _is_open(self, name: str) -> bool:
+		return name in self.__dict__
+
+	@staticmethod
+	def seen_key(site: str, url: str) -> str:
+		# different urls of the same art are the same key
+		return site + ':' + completed_key(site, url)
+
+	def complete(self, site: str, url: str):
+		""" Remember that everything from url is downloaded """
+		key = self.seen_key(site, url)
+		self.seen.add(key)
+		self.adb.insert((None, key), Completed(key, int(time())))
+
+	async def filter_completed(self, site: str, urls: list[str]) -> list[str]:
+		""" Returns urls which are not downloaded completely """
+		keys = {
+			u: self.seen_key(site, u)
+			for u in urls
+		}
+		# bloom filter can give false positive, so check them in db
+		completed: set[str] = set()
+		not_pending = []
+		for key in keys.values():
+			if key not in self.seen:
+				continue
+			is_pending, row = self.adb.pending_row((None, key))
+			if not is_pending:
+				not_pending.append(key)
+			elif row is not None:
+				completed.add(key)
+
+		if len(not_pending) > 0:
+			completed.update(await self.adb.run(self.db.completed, not_pending))
+		return [u for u in urls if keys[u] not in completed]
+
+	async def has(self, site: str, site_id: str) -> bool:
+		is_pending, row = self.adb.pending_row((site, site_id))
+		if is_pending:
+			return row is not None
+		return await self.adb.run(self.db.has, site, site_id)
+
+	async def has_many(self, site: str, site_ids: list[str]) -> set[str]:
+		""" Returns recorded ids """
+		result: set[str] = set()
+		not_pending = []
+		for site_id in site_ids:
+			is_pending, row = self.adb.pending_row((site, site_id))
+			if not is_pending:
+				not_pending.append(site_id)
+			elif row is not None:
+				result.add(site_id)
+
+		result.update(await self.adb.run(self.db.has_many, site, not_pending))
+		return result
+
+	async def exists(self, site: str, site_id: str, filename: str) -> bool:
+		""" Check ledger, then file on disk (it can be downloaded before ledger was added) """
+		return await self.has(site, site_id) or file_index.exists(filename)
+
+	def record(
+		self,
+		site: str,
+		site_id: str,
+		*,
+		source: str | None,
+		url: str,
+		path: str,
+		size: int,
+		hash: str,
+	):
+		record = Record(site, site_id, source, url, path, size, hash, int(time()))
+		self.adb.insert((site, site_id), record)
+
+	async def flush(self):
+		if self._is_open('adb'):
+			await self.adb.flush()
+
+	def flush_sync(self):
+		if self._is_open('adb'):
+			self.adb.flush_sync()
+		if self._is_open('seen'):
+			self.seen.flush()
+
+	def verify(self):
+		""" Check that recorded files exist and not truncated, requeue broken downloads """
+		self.flush_sync()
+
+		checked = 0
+		broken: list[Record] = []
+		with ThreadPoolExecutor(VERIFY_WORKERS) as pool:
+			for records in self.db.records():
+				checked += len(records)
+				for record, valid in zip(records, pool.map(_is_valid, records)):
+					if not valid:
+						broken.append(record)
+
+		to_retry: dict[str, str] = {}
+		for record in broken:
+			logger.verbose('broken', record.path)
+			if os.path.exists(record.path):
+				os.remove(record.path)
+				file_index.discard(record.path)
+			if record.source is not None:
+				to_retry[record.source] = self.seen_key(record.site, record.source)
+
+		self.db.write_many({
+			(r.site, r.site_id): None
+			for r in broken
+		})
+		# false positive in bloom filter is checked in db, so removing only from db is enough
+		self.db.uncomplete(list(to_retry.values()))
+		if len(to_retry) > 0:
+			retry.add(list(to_retry))
+
+		logger.info('checked:', checked, 'broken:', len(broken), 'requeued urls:', len(to_retry))
+
+
+ledger = Ledger()
@@ -1,6 +1,8 @@
 from importlib import import_module
 from typing import Any, Callable, Coroutine
 
+from art_dl.utils.url import normalize_url
+
 MODULE = 'art_dl.sites.'
 
 
@@ -10,3 +12,42 @@ def download(slug: str) -> Callable[[list[str], str], Coroutine[Any, Any, None]]
 
 def register(slug: str) -> Callable[[], None]:
 	return import_module(MODULE + slug).register
+
+
+def _first(urls: list[str]) -> str:
+	return urls[0]
+
+
+def canonical(slug: str) -> Callable[[str], str | None]:
+	"""
+	Function which returns id of art/artist/etc from url, it's the same for all forms of url.
+	`None` means that url is not supported. If site does not define it, url is normalized
+	"""
+	return getattr(import_module(MODULE + slug), 'canonical', normalize_url)
+
+
+def merge(slug: str) -> Callable[[list[str]], str]:
+	""" Function which merges urls with the same canonical id into one url """
+	return getattr(import_module(MODULE + slug), 'merge', _first)
+
+
+def _key(func: Callable[[str], str | None], url: str) -> str:
+	try:
+		key = func(url)
+	except Exception:
+		# url is reported by site when downloading
+		key = None
+	return key or normalize_url(url)
+
+
+def canonical_key(slug: str, url: str) -> str:
+	""" Canonical id of url, urls which can't be parsed are compared as normalized url """
+	return _key(canonical(slug), url)
+
+
+def completed_key(slug: str, url: str) -> str:
+	"""
+	Key of url in list of completed urls, it's canonical id by default. Site can define
+	`completed_key` if urls with the same id can be downloaded partially, e.g. range of pages
+	"""
+	return _key(getattr(import_module(MODULE + slug), 'completed_key', canonical(slug)), url)
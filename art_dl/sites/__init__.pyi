@@ -3,7 +3,7 @@ from typing import Any, Callable, Coroutine
 # import for mypy
 from .artstation import download as _
 from .danbooru import download as _
-from .deviantart import download as _
+from .deviantart.download import download as _
 from .imgur import download as _
 from .pixiv import download as _
 from .reddit import download as _
@@ -12,3 +12,7 @@ from .wallhaven import download as _
 
 def download(slug: str) -> Callable[[list[str], str], Coroutine[Any, Any, None]]: ...
 def register(slug: str) -> Callable[[], None]: ...
+def canonical(slug: str) -> Callable[[str], str | None]: ...
+def merge(slug: str) -> Callable[[list[str]], str]: ...
+def canonical_key(slug: str, url: str) -> str: ...
+def completed_key(slug: str, url: str) -> str: ...
@@ -1,20 +1,29 @@
 import os.path
+from asyncio import gather
 from collections import Counter, defaultdict, namedtuple
 from enum import Enum
-from functools import reduce
+from functools import partial, reduce
 from urllib.parse import urlparse
 
 from art_dl.cache import cache
+from art_dl.ledger import ledger
 from art_dl.log import Logger, Progress
 from art_dl.utils.download import download_binary
+from art_dl.utils.limit import host_limiter
 from art_dl.utils.path import mkdir
 from art_dl.utils.print import counter2str
 from art_dl.utils.proxy import ClientSession, ProxyClientSession
+from art_dl.utils.singleflight import flight
+from art_dl.utils.url import normalize_url
 
 SLUG = 'artstation'
 BASE_URL = 'https://www.artstation.com'
 USER_PROJECTS_URL = '/users/{user}/projects.json'
+# hash of newest project of artist is saved with this key,
+# next time projects are listed until this project
+PROJECTS_CACHE_PREFIX = 'projects:'
 PROJECT_INFO_URL = '/projects/{hash}.json'
+ARTWORK_URL = '/artwork/{hash}'
 
 logger = Logger(inline=True)
 progress = Progress()
@@ -47,15 +56,46 @@ def parse_link(url: str) -> Parsed:
 	return Parsed(path[0], ParsedType.artist)
 
 
-async def list_projects(session: ClientSession, user: str):
-	async with session.get(USER_PROJECTS_URL.format(user=user)) as response:
-		return (await response.json())['data']
+def canonical(url: str) -> str | None:
+	parsed = parse_link(url)
+	if not parsed.id:
+		return None
+	return parsed.type.value + '/' + parsed.id
+
+
+async def _list_projects(session: ClientSession, user: str, mark: str | None):
+	url = USER_PROJECTS_URL.format(user=user)
+	result = []
+	page = 1
+	while True:
+		logger.info('list', user, 'page', page, progress=progress)
+		async with host_limiter(BASE_URL):
+			async with session.get(url, params={
+				'page': page
+			}) as response:
+				data = await response.json()
+
+		result.extend(data['data'])
+		# projects are sorted from newest, so page with last known project is the last one
+		if (
+			len(data['data']) == 0 or len(result) >= data['total_count']
+			or any(p['hash_id'] == mark for p in data['data'])
+		):
+			return result
+		page += 1
+
+
+async def list_projects(session: ClientSession, user: str, mark: str | None = None):
+	""" List projects of user, stops on page with `mark` project """
+	url = BASE_URL + USER_PROJECTS_URL.format(user=user)
+	return await flight.do(normalize_url(url), partial(_list_projects, session, user, mark))
 
 
 async def fetch_project(session: ClientSession, project: str):
-	async with session.get(PROJECT_INFO_URL.format(hash=project)) as response:
-		logger.info('add', project, progress=progress)
-		result = await response.json()
+	async with host_limiter(BASE_URL):
+		async with session.get(PROJECT_INFO_URL.format(hash=project)) as response:
+			logger.info('add', project, progress=progress)
+			result = await response.json()
 
 	return {
 		'assets': list({
@@ -96,31 +136,46 @@ async def fetch_asset(
 	]).strip(sep).replace(sep * 2, sep)
 	filename = os.path.join(save_folder, name)
 
-	if os.path.exists(filename):
+	if await ledger.exists(SLUG, str(asset_id), filename):
 		logger.verbose('skip existing', project_hash, asset_id, progress=progress)
 		return DownloadResult.skip
 
 	logger.info('download', project_hash, asset_id, progress=progress)
-	await download_binary(session, asset['image_url'], filename)
+	await download_binary(
+		session,
+		asset['image_url'],
+		filename,
+		site=SLUG,
+		site_id=str(asset_id),
+		source=BASE_URL + ARTWORK_URL.format(hash=project_hash),
+	)
 	return DownloadResult.download
 
 
 async def download(urls: list[str], data_folder: str):
 	stats = Counter()  # type: ignore
-	progress.total = len(urls)
+	progress.set(0, len(urls))
 
 	# { '<artist>': [Project(1), ...] }
 	projects: dict[str, list[Project]] = defaultdict(list)
 
+	# { '<artist>': '<hash of newest project>' }
+	marks: dict[str, str] = {}
+
 	logger.configure(prefix=[SLUG, 'queue'], inline=True)
-	for url in urls:
-		progress.i += 1
+	async with ProxyClientSession(BASE_URL) as session:
+		for url in urls:
+			progress.i += 1
 
-		parsed = parse_link(url)
+			parsed = parse_link(url)
 
-		async with ProxyClientSession(BASE_URL) as session:
 			if parsed.type == ParsedType.artist:
-				projects_list = [p['hash_id'] for p in await list_projects(session, parsed.id)]
+				mark_key = PROJECTS_CACHE_PREFIX + parsed.id.lower()
+				mark = await cache.aselect(SLUG, mark_key)
+				listed = await list_projects(session, parsed.id, mark)
+				projects_list = [p['hash_id'] for p in listed]
+				if len(projects_list) > 0:
+					marks[mark_key] = projects_list[0]
 				stats.update(artist=1)
 			elif parsed.type == ParsedType.art:
 				projects_list = [parsed.id]
@@ -130,18 +185,15 @@ async def download(urls: list[str], data_folder: str):
 				logger.verbose('error parsing')
 				continue
 
-			for project_hash in projects_list:
-				cached: dict = cache.select(SLUG, project_hash, as_json=True)
-
-				if cached is None:
-					p = await fetch_project(session, project_hash)
-					cache.insert(SLUG, project_hash, p, as_json=True)
-				else:
-					p = cached
-
+			infos = await gather(
+				*(cache.fetch(SLUG, h, partial(fetch_project, session, h)) for h in projects_list)
+			)
+			for p in infos:
 				artist = p['user']['username']
 				projects[artist].append(Project(p['title'], p['hash_id'], p['assets']))
 
+		await cache.revalidated()
+
 	for artist in projects.keys():
 		mkdir(os.path.join(data_folder, artist))
 
@@ -169,7 +221,12 @@ async def download(urls: list[str], data_folder: str):
 					progress.i += 1
 
 					res = await fetch_asset(session, project.hash_id, asset, save_folder, sub)
-					stats.update({res.value: 1})
+					stats.update({
+						res.value: 1
+					})
+
+	for mark_key, mark in marks.items():
+		await cache.ainsert(SLUG, mark_key, mark)
 
 	logger.configure(prefix=[SLUG], inline=True)
 	logger.info(counter2str(stats))
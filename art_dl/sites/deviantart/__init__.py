@@ -1,9 +1,10 @@
-from .download import download
+from .download import canonical, download
 from .register import register
 from .service import DAService
 
 __all__ = [
 	'DAService',
+	'canonical',
 	'download',
 	'register',
 ]
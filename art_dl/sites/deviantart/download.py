@@ -1,13 +1,14 @@
 # from aiohttp import ClientSession
 import os.path
 from collections import Counter, defaultdict
-from glob import glob
 from typing import Any
 from urllib.parse import urlparse
 
 from art_dl.cache import cache
+from art_dl.ledger import ledger
 from art_dl.sites.deviantart.common import SLUG, make_cache_key
 from art_dl.utils.download import download_binary
+from art_dl.utils.file_index import file_index, name_stem
 from art_dl.utils.path import mkdir
 from art_dl.utils.print import counter2str
 from art_dl.utils.proxy import ClientSession, ProxyClientSession
@@ -62,33 +63,54 @@ def parse_link(url: str) -> dict[str, str]:
 	}
 
 
+def canonical(url: str) -> str | None:
+	parsed = parse_link(url)
+	# usernames are case-insensitive
+	artist = parsed['artist'].lower()
+	if artist == '':
+		return None
+	t = parsed['type']
+	if t == 'all':
+		return artist
+	if t == 'folder':
+		return artist + '/gallery/' + parsed['folder']
+	if t == 'art':
+		return artist + '/art/' + parsed['name']
+	return None
+
+
 # download images
 
 
-async def save_from_url(session: ClientSession, url: str, folder: str, name: str):
+async def save_from_url(session: ClientSession, url: str, folder: str, name: str, art: Any):
 	ext = os.path.splitext(urlparse(url).path)[1]
 	filename = os.path.join(folder, name + ext)
-	if os.path.exists(filename):
+	if file_index.exists(filename):
 		return logger.info('skip existing file', name, progress=progress)
 
 	logger.info('download file', name, progress=progress)
-	await download_binary(session, url, filename)
+	await download_binary(
+		session, url, filename, site=SLUG, site_id=art['deviationid'], source=art['url']
+	)
 
 
 async def save_art(service: DAService, session: ClientSession, art: Any, folder: str):
 	url: str = art['url']
 	name = url.rsplit('/', 1)[-1]
 
+	if await ledger.has(SLUG, art['deviationid']):
+		return logger.verbose('skip downloaded', name, progress=progress)
+
 	if (premium_folder_data := art.get('premium_folder_data')) is not None:
 		if premium_folder_data['has_access'] is False:
 			logger.warn('no access to', name + ',', 'downloading preview', progress=progress)
 
 	if art['is_downloadable'] is False or art['download_filesize'] == art['content']['filesize']:
-		return await save_from_url(session, art['content']['src'], folder, name)
+		return await save_from_url(session, art['content']['src'], folder, name, art)
 
 	original_url = await service.get_download(art['deviationid'])
 	if original_url is not None:
-		await save_from_url(session, original_url, folder, name)
+		await save_from_url(session, original_url, folder, name, art)
 
 
 # wrappers for common actions
@@ -111,7 +133,7 @@ async def download_art_by_id(service: DAService, deviationid: str, folder: str):
 
 
 def is_art_exists(folder: str, artist: str, name: str):
-	return len(glob(f'{folder}/{artist}/{name}.*')) > 0
+	return name in file_index.get(os.path.join(folder, artist), name_stem)
 
 
 # main functions
@@ -119,7 +141,7 @@ def is_art_exists(folder: str, artist: str, name: str):
 
 async def download(urls: list[str], data_folder: str):
 	stats = Counter()  # type: ignore
-	progress.total = len(urls)
+	progress.set(0, len(urls))
 
 	service = DAService()
 
@@ -141,14 +163,16 @@ async def download(urls: list[str], data_folder: str):
 			mapping_folder[a].append(parsed['folder'])
 		elif t == 'art':
 			n = parsed['name']
-			if is_art_exists(data_folder, a, n):
+			deviationid = await cache.aselect(SLUG, make_cache_key(a, u))
+			if ((deviationid is not None and await ledger.has(SLUG, deviationid))
+				or is_art_exists(data_folder, a, n)):
 				stats.update(skip=1)
 				progress.i += 1
 
 				logger.info('skip existing', a + '/' + n, progress=progress)
+				ledger.complete(SLUG, u)
 				continue
 
-			deviationid = cache.select(SLUG, make_cache_key(a, u))
 			if deviationid is not None:
 				stats.update(download=1)
 				progress.i += 1
@@ -157,6 +181,7 @@ async def download(urls: list[str], data_folder: str):
 				save_folder = os.path.join(data_folder, a)
 				mkdir(save_folder)
 				await download_art_by_id(service, deviationid, save_folder)
+				ledger.complete(SLUG, u)
 				continue
 
 			mapping_art[a].append({
@@ -192,7 +217,7 @@ async def download(urls: list[str], data_folder: str):
 		mkdir(save_folder)
 		logger.info('artist', artist, progress=progress)
 
-		async for folder in service.list_folders(artist):
+		for folder in await service.get_folders(artist):
 			if folder['name'] in folder_list:
 				logger.info('gallery', folder['pretty_name'], progress=progress)
 				await download_folder_by_id(service, save_folder, artist, folder['id'])
@@ -212,6 +237,7 @@ async def download(urls: list[str], data_folder: str):
 				url = art['url']
 				if any(filter(lambda a: a['url'] == url, art_list)):  # type: ignore
 					await save_art(service, session, art, save_folder)
+					ledger.complete(SLUG, url)
 
 					all_urls.remove(url)
 					if len(all_urls) == 0:
@@ -1,10 +1,12 @@
 # from aiohttp import ClientSession
 from asyncio import sleep
+from functools import partial
 from typing import Any, AsyncGenerator
 
 from art_dl.cache import cache
 from art_dl.utils.credentials import creds
 from art_dl.utils.proxy import ClientSession, ProxyClientSession
+from art_dl.utils.singleflight import flight
 
 from .common import (
 	AUTH_LOG_PREFIX,
@@ -56,7 +58,9 @@ class DAService():
 
 		async with ProxyClientSession(BASE_URL) as session:
 			async with session.post(
-				'/api/v1/oauth2/placebo', params={ 'access_token': self.access_token }
+				'/api/v1/oauth2/placebo', params={
+					'access_token': self.access_token
+				}
 			) as response:
 				if (await response.json())['status'] == 'success':
 					return
@@ -182,6 +186,15 @@ class DAService():
 					'pretty_name': name,
 				}
 
+	async def _collect_folders(self, username: str) -> list[Any]:
+		return [folder async for folder in self.list_folders(username)]
+
+	async def get_folders(self, username: str) -> list[Any]:
+		""" The same as `list_folders`, but concurrent calls for one artist make one request """
+		return await flight.do(
+			f'{SLUG}:folders:{username.lower()}', partial(self._collect_folders, username)
+		)
+
 	async def list_folder_arts(self, username: str, folder_id: str) -> AsyncGenerator[Any, None]:
 		await self._ensure_access()
 
@@ -192,7 +205,7 @@ class DAService():
 		async with ProxyClientSession(BASE_URL, headers=self._headers) as session:
 			async for art in self._pager(session, 'GET', url, params=params):
 				if art is not None:
-					cache.insert(
+					await cache.ainsert(
 						SLUG, make_cache_key(art['author']['username'], art['url']),
 						art['deviationid']
 					)
@@ -1,18 +1,29 @@
 import os.path
+from asyncio import gather
 from collections import Counter, namedtuple
 from enum import Enum
+from functools import partial
+from time import perf_counter
 from typing import Any
 from urllib.parse import urlparse
 
 from art_dl.cache import cache
+from art_dl.ledger import ledger
 from art_dl.log import Logger, Progress
 from art_dl.utils.download import download_binary
+from art_dl.utils.file_index import file_index
 from art_dl.utils.path import filename_normalize, mkdir
-from art_dl.utils.print import counter2str
+from art_dl.utils.print import counter2str, format_size
 from art_dl.utils.proxy import ClientSession, ProxyClientSession
 
 SLUG = 'imgur'
 API_URL = 'https://api.imgur.com/3/{type}/{id}'
+DIRECT_URL = 'https://i.imgur.com/{id}{ext}'
+# gifv is html page with video
+DIRECT_EXT = {
+	'.gifv': '.mp4',
+}
+SEP = ' - '
 # client_id just from devtools
 HEADERS = {
 	'authorization': 'Client-ID 546c25a59c58ad7'
@@ -21,12 +32,15 @@ HEADERS = {
 logger = Logger(prefix=[SLUG, 'download'], inline=True)
 progress = Progress()
 
-Parsed = namedtuple('Parsed', ['id', 'type'], defaults=[None, None])
+# ext is set only for direct links
+Parsed = namedtuple('Parsed', ['id', 'type', 'ext'], defaults=[None, None, None])
 
 
 class LinkType(str, Enum):
 	album = 'album'
 	image = 'image'
+	# link to file
+	direct = 'direct'
 
 
 class DownloadResult(str, Enum):
@@ -38,6 +52,11 @@ def parse_link(url: str):
 	parsed = urlparse(url)
 	path = parsed.path.lstrip('/').split('/')
 
+	if parsed.netloc == 'i.imgur.com' and len(path) == 1:
+		# https://i.imgur.com/<id>.<ext>
+		image_id, ext = os.path.splitext(path[0])
+		return Parsed(image_id, LinkType.direct, DIRECT_EXT.get(ext, ext))
+
 	if path[0] == 'a' or path[0] == 'gallery':
 		# https://imgur.com/a/<id>
 		# https://imgur.com/gallery/<id>
@@ -54,6 +73,15 @@ def parse_link(url: str):
 	return Parsed()
 
 
+def canonical(url: str) -> str | None:
+	parsed = parse_link(url)
+	if not parsed.id:
+		return None
+	# direct link is the same image
+	link_type = LinkType.image if parsed.type == LinkType.direct else parsed.type
+	return link_type.value + '/' + parsed.id
+
+
 async def fetch_info(session: ClientSession, album: Parsed) -> Any:
 	logger.verbose('fetch info', album.id, progress=progress)
 
@@ -79,23 +107,124 @@ async def fetch_info(session: ClientSession, album: Parsed) -> Any:
 
 
 async def download_art(
-	session: ClientSession, link: str, save_folder: str, name: str
+	session: ClientSession, image: dict, save_folder: str, name: str, source: str
 ) -> DownloadResult:
 	filename = os.path.join(save_folder, name)
-	if os.path.exists(filename):
+	if await ledger.exists(SLUG, image['id'], filename):
 		logger.verbose('skip existing', name, progress=progress)
 		return DownloadResult.skip
 
 	logger.info('download', name, progress=progress)
-	await download_binary(session, link, filename)
+	await download_binary(
+		session, image['link'], filename, site=SLUG, site_id=image['id'], source=source
+	)
 	return DownloadResult.download
 
 
-async def download(urls: list[str], data_folder: str):
+def image_name(title_prefix: str, image: dict) -> str:
+	title = SEP.join((title_prefix, image['title'], image['id'])).strip(SEP).replace(SEP * 2, SEP)
+	return title + image['ext']
+
+
+def album_prefix(info: dict) -> str:
+	return filename_normalize(SEP.join((info['title'], info['id'])).strip(SEP))
+
+
+async def download_direct(
+	session: ClientSession, parsed: Parsed, data_folder: str, source: str
+) -> DownloadResult:
+	""" Download file without api request, cached info is used for naming if it exists """
+	info = await cache.aselect(SLUG, parsed.id, as_json=True)
+	if info is not None and len(info['images']) == 1:
+		image = info['images'][0]
+		name = image_name(album_prefix(info), image)
+	else:
+		image = {
+			'id': parsed.id,
+			'link': DIRECT_URL.format(id=parsed.id, ext=parsed.ext),
+		}
+		name = parsed.id + parsed.ext
+
+	mkdir(data_folder)
+	return await download_art(session, image, data_folder, name, source)
+
+
+async def _download_image(
+	session: ClientSession,
+	image: dict,
+	save_folder: str,
+	name: str,
+	source: str,
+	album_progress: Progress,
+) -> int:
+	size = await download_binary(
+		session,
+		image['link'],
+		os.path.join(save_folder, name),
+		site=SLUG,
+		site_id=image['id'],
+		source=source,
+	)
+	album_progress.i += 1
+	logger.info('downloaded', name, progress=album_progress)
+	return size
+
+
+async def download_album(
+	session: ClientSession, info: dict, save_folder: str, source: str
+) -> Counter:
+	"""
+	Download images concurrently, number of concurrent downloads is limited in `download_binary`.
+	Number of failed images is in `error`
+	"""
 	stats = Counter()  # type: ignore
-	progress.total = len(urls)
+	images = info['images']
+	downloaded = await ledger.has_many(SLUG, [i['id'] for i in images])
+	# one directory scan for the whole album
+	existing = file_index.get(save_folder)
+
+	album_progress = Progress()
+	to_download = []
+	for image in images:
+		name = image_name('', image)
+		if image['id'] in downloaded or name in existing:
+			stats.update(skip=1)
+		else:
+			to_download.append(
+				_download_image(session, image, save_folder, name, source, album_progress)
+			)
+	album_progress.total = len(to_download)
+
+	if len(to_download) == 0:
+		logger.verbose('skip existing album', info['id'], progress=progress)
+		return stats
+
+	logger.info('download album', info['id'], f'({len(to_download)} images)', progress=progress)
+	start = perf_counter()
+	size = 0
+	for res in await gather(*to_download, return_exceptions=True):
+		if isinstance(res, Exception):
+			logger.verbose('error in album', info['id'] + ':', res, progress=progress)
+			stats.update(error=1)
+		else:
+			size += res  # type: ignore
+			stats.update(download=1)
+
+	elapsed = perf_counter() - start
+	logger.info(
+		'album',
+		info['id'] + ':',
+		format_size(size),
+		f'in {elapsed:.1f}s,',
+		format_size(size / elapsed) + '/s',
+		progress=progress,
+	)
+	return stats
+
 
-	sep = ' - '
+async def download(urls: list[str], data_folder: str):
+	stats = Counter()  # type: ignore
+	progress.set(0, len(urls))
 
 	async with ProxyClientSession() as session:
 		for url in urls:
@@ -108,35 +237,50 @@ async def download(urls: list[str], data_folder: str):
 				stats.update(skip=1)
 				continue
 
-			cached = cache.select(SLUG, parsed.id, as_json=True)
+			if parsed.type == LinkType.direct:
+				res = await download_direct(session, parsed, data_folder, url)
+				stats.update({
+					res.value: 1
+				})
+				ledger.complete(SLUG, url)
+				continue
 
-			if cached is None:
-				info = await fetch_info(session, parsed)
-				cache.insert(SLUG, parsed.id, info, as_json=True)
-			else:
-				info = cached
+			if parsed.type == LinkType.image and await ledger.has(SLUG, parsed.id):
+				logger.verbose('skip existing', parsed.id, progress=progress)
+				stats.update(skip=1)
+				continue
+
+			info = await cache.fetch(SLUG, parsed.id, partial(fetch_info, session, parsed))
 
 			images = info['images']
 			one_image = len(images) == 1
-			title_prefix = sep.join((info['title'], info['id'])).strip(sep)
-			title_prefix = filename_normalize(title_prefix)
+			title_prefix = album_prefix(info)
 
-			if one_image:
-				save_folder = data_folder
-			else:
-				# save to sub-folder
-				save_folder = os.path.join(data_folder, title_prefix)
-				title_prefix = ''
+			# album is saved to sub-folder
+			save_folder = data_folder if one_image else os.path.join(data_folder, title_prefix)
 			mkdir(save_folder)
 
-			for image in images:
-				title = (
-					sep.join((title_prefix, image['title'], image['id'])
-								).strip(sep).replace(sep * 2, sep)
+			if one_image:
+				image = images[0]
+				res = await download_art(
+					session, image, save_folder, image_name(title_prefix, image), url
 				)
-				name = title + image['ext']
-				res = await download_art(session, image['link'], save_folder, name)
-				stats.update({res.value: 1})
+				stats.update({
+					res.value: 1
+				})
+			else:
+				album_stats = await download_album(session, info, save_folder, url)
+				stats.update(album_stats)
+				if album_stats['error'] > 0:
+					logger.warn('failed', album_stats['error'], 'images in', url, progress=progress)
+					continue
+
+			# albums can be changed, so they are checked every time,
+			# downloaded images are skipped by ledger
+			if parsed.type == LinkType.image:
+				ledger.complete(SLUG, url)
+
+		await cache.revalidated()
 
 	logger.info(counter2str(stats))
 	logger.newline(normal=True)
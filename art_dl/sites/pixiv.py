@@ -1,25 +1,47 @@
 import json
 import os.path
-from asyncio import sleep
+import re
+from asyncio import TimeoutError, gather, sleep
 from collections import Counter, namedtuple
+from functools import partial
 from urllib.parse import parse_qs, urlparse
 
-from aiohttp import ServerDisconnectedError
-from lxml import etree
+from aiohttp import ClientConnectionError, ClientError, ClientPayloadError
 
 from art_dl.cache import cache
+from art_dl.ledger import ledger
 from art_dl.log import Logger, Progress
 from art_dl.utils.download import download_binary
+from art_dl.utils.html import Extractor, Selector
 from art_dl.utils.path import filename_normalize, filename_unhide, mkdir
 from art_dl.utils.print import counter2str
 from art_dl.utils.proxy import ClientSession, ProxyClientSession
-from art_dl.utils.url import parse_range
+from art_dl.utils.url import format_range, parse_range
 
 SLUG = 'pixiv'
 HEADERS = {
 	'referer': 'https://www.pixiv.net/',
 }
 URL = 'https://www.pixiv.net/en/artworks/'
+API_URL = 'https://www.pixiv.net/ajax/illust/'
+USER_WORKS_URL = 'https://www.pixiv.net/ajax/user/{user}/profile/all'
+USER_WORKS_INFO_URL = 'https://www.pixiv.net/ajax/user/{user}/profile/illusts'
+ORIGINAL_URL = 'https://i.pximg.net/img-original/img/{date}/{id}_p0{ext}'
+# page is retried this number of times after connection errors,
+# with delay RETRY_DELAY * 2^n seconds
+PAGE_RETRIES = 4
+RETRY_DELAY = 5
+RETRY_ERRORS = (ClientConnectionError, ClientPayloadError, TimeoutError)
+# number of works in one request
+WORKS_CHUNK = 100
+# list of works does not contain extension of original image, so these are tried
+PROBE_EXTS = ('.jpg', '.png', '.gif')
+# https://i.pximg.net/c/250x250_80_a2/img-master/img/<date>/<id>_p0_square1200.jpg
+THUMB_DATE = re.compile(r'/img/(\d{4}/\d{2}/\d{2}/\d{2}/\d{2}/\d{2})/')
+# page is read by chunks of this size until data is found
+STREAM_CHUNK = 16 * 1024
+# <id>_p<page>.<ext>
+DIRECT_NAME = re.compile(r'^(\d+)_p(\d+)[._]')
 
 ERROR_MESSAGES = {
 	'404': 'artwork has been deleted or the ID does not exist',
@@ -29,7 +51,12 @@ ERROR_MESSAGES = {
 logger = Logger(prefix=[SLUG, 'download'], inline=True)
 progress = Progress()
 
-Parsed = namedtuple('Parsed', ['id', 'range'], defaults=[None, None])
+PAGE_EXTRACTOR = Extractor(
+	'pixiv page', [Selector('data', '//meta[@name=\'preload-data\']/@content', convert=json.loads)]
+)
+
+# direct is a link to file of one page, user is set for links to all works of user
+Parsed = namedtuple('Parsed', ['id', 'range', 'direct', 'user'], defaults=[None, None, None, None])
 
 
 def parse_link(url: str):
@@ -42,11 +69,26 @@ def parse_link(url: str):
 		# to indexing like range() function, which starts from 0
 		imgs_range = list(map(lambda i: i - 1, imgs_range))
 
+	if parsed.netloc == 'i.pximg.net':
+		if (match := DIRECT_NAME.match(path[-1])) is None:
+			return Parsed()
+		if 'img-original' not in path:
+			# resized image, e.g. https://i.pximg.net/img-master/img/<date>/<id>_p0_master1200.jpg,
+			# original is downloaded like page of artwork
+			return Parsed(match[1], [int(match[2])])
+		# https://i.pximg.net/img-original/img/<date>/<id>_p<page>.<ext>
+		return Parsed(match[1], [int(match[2])], url)
+
 	if parsed.netloc == 'zettai.moe':
 		# https://zettai.moe/detail?id=<id>
 		query = parse_qs(parsed.query)
 		return Parsed(query['id'][0], imgs_range)
 
+	if len(path) > 1 and path[-2] == 'users':
+		# https://www.pixiv.net/users/<id>
+		# https://www.pixiv.net/<lang>/users/<id>
+		return Parsed(user=path[-1])
+
 	if path[1] == 'artworks':
 		# https://www.pixiv.net/<lang>/artworks/<id>
 		return Parsed(path[2], imgs_range)
@@ -58,20 +100,40 @@ def parse_link(url: str):
 	return Parsed()
 
 
-async def fetch_info(session: ClientSession, parsed: Parsed):
-	url = URL + parsed.id
-	logger.info('fetch info', parsed.id, progress=progress)
-	async with session.get(url) as response:
-		if response.status == 404:
-			return {
-				'error': '404'
-			}
-		data = await response.text()
+def canonical(url: str) -> str | None:
+	parsed = parse_link(url)
+	if parsed.user is not None:
+		return 'users/' + parsed.user
+	# range is not included, urls with ranges are merged
+	return parsed.id
+
+
+def completed_key(url: str) -> str | None:
+	""" Url with range of pages is downloaded partially, so range is a part of key """
+	parsed = parse_link(url)
+	if parsed.range is None or parsed.user is not None:
+		return canonical(url)
+	return parsed.id + '#' + format_range([i + 1 for i in parsed.range])
+
 
-	root = etree.HTML(data)
-	json_data = json.loads(root.xpath('//meta[@name=\'preload-data\']/@content')[0])
-	art = json_data['illust'][parsed.id]
+def merge(urls: list[str]) -> str:
+	""" Merge ranges of images, url without range means all images """
+	if len(urls) == 1 or parse_link(urls[0]).user is not None:
+		return urls[0]
 
+	pages: set[int] = set()
+	for u in urls:
+		parsed = parse_link(u)
+		if parsed.range is None:
+			return URL + parsed.id
+		# back to pixiv indexing
+		pages.update(i + 1 for i in parsed.range)
+
+	return URL + canonical(urls[0]) + '#' + format_range(list(pages))  # type: ignore
+
+
+def _art_info(art_id: str, art: dict) -> dict:
+	""" Convert illust object, it's the same in api and in page """
 	if art['urls']['original'] is None:
 		return {
 			'error': 'no_original_url'
@@ -80,18 +142,134 @@ async def fetch_info(session: ClientSession, parsed: Parsed):
 	return {
 		'count': art['pageCount'],
 		'first_url': art['urls']['original'],
-		'id': parsed.id,
+		'id': art_id,
 		# username can begin with a dot
 		'artist': filename_unhide(filename_normalize(art['userName'])),
 		'title': filename_normalize(art['title']),
 	}
 
 
+async def fetch_info_page(session: ClientSession, parsed: Parsed):
+	async with session.get(URL + parsed.id) as response:
+		if response.status == 404:
+			return {
+				'error': '404'
+			}
+		# rest of page is not downloaded after data is found
+		chunks = response.content.iter_chunked(STREAM_CHUNK)
+		data = (await PAGE_EXTRACTOR.extract_stream(chunks))['data']
+
+	if data is None:
+		raise ValueError(f'no data on page of {parsed.id}')
+	return _art_info(parsed.id, data['illust'][parsed.id])
+
+
+async def fetch_info(session: ClientSession, parsed: Parsed):
+	logger.info('fetch info', parsed.id, progress=progress)
+	try:
+		async with session.get(API_URL + parsed.id) as response:
+			if response.status == 404:
+				return {
+					'error': '404'
+				}
+			response.raise_for_status()
+			art = (await response.json())['body']
+		return _art_info(parsed.id, art)
+	except (ClientError, KeyError, TypeError, ValueError) as e:
+		logger.verbose('api error, fetching page', parsed.id + ':', e, progress=progress)
+		return await fetch_info_page(session, parsed)
+
+
+async def list_user_works(session: ClientSession, user: str) -> list[str]:
+	logger.info('fetch works of user', user, progress=progress)
+	async with session.get(USER_WORKS_URL.format(user=user)) as response:
+		response.raise_for_status()
+		body = (await response.json())['body']
+
+	# empty list instead of dict if there are no works
+	ids = [*(body['illusts'] or {}), *(body['manga'] or {})]
+	return sorted(ids, key=int, reverse=True)
+
+
+async def fetch_works_info(session: ClientSession, user: str, ids: list[str]):
+	""" Save info of works to cache, `first_url` has guessed extension and `probe` flag """
+	for i in range(0, len(ids), WORKS_CHUNK):
+		chunk = ids[i:i + WORKS_CHUNK]
+		logger.info('fetch info of works', i + len(chunk), '/', len(ids), progress=progress)
+
+		params = [('ids[]', work_id) for work_id in chunk]
+		params += [('work_category', 'illustManga'), ('is_first_page', '0')]
+		async with session.get(USER_WORKS_INFO_URL.format(user=user), params=params) as response:
+			response.raise_for_status()
+			works = (await response.json())['body']['works']
+
+		infos = {}
+		for work_id, work in works.items():
+			if (match := THUMB_DATE.search(work['url'] or '')) is None:
+				# info is fetched later for each artwork
+				continue
+			first_url = ORIGINAL_URL.format(date=match[1], id=work_id, ext=PROBE_EXTS[0])
+			infos[work_id] = {
+				**_art_info(work_id, {
+					**work,
+					'urls': {
+						'original': first_url
+					},
+				}),
+				'probe': True,
+			}
+		await cache.ainsert_many(SLUG, infos, as_json=True)
+
+
+async def probe_ext(session: ClientSession, base_url: str) -> str | None:
+	""" Find extension of original image, `base_url` is url without extension """
+	for ext in PROBE_EXTS:
+		async with session.head(base_url + ext) as response:
+			if response.ok:
+				return ext
+			if response.status != 404:
+				response.raise_for_status()
+	return None
+
+
+async def user_works_urls(session: ClientSession, user: str) -> list[str]:
+	""" Urls of works which are not downloaded, their info is cached """
+	works = await list_user_works(session, user)
+	urls = await ledger.filter_completed(SLUG, [URL + i for i in works])
+	to_fetch = []
+	for url in urls:
+		work_id = parse_link(url).id
+		if await cache.aselect(SLUG, work_id, as_json=True) is None:
+			to_fetch.append(work_id)
+
+	await fetch_works_info(session, user, to_fetch)
+	logger.info('new works of user', user + ':', len(urls), progress=progress)
+	return urls
+
+
 async def download_art(
 	session: ClientSession, art_info: Parsed, info: dict, save_folder: str
 ) -> Counter:
 	stats = Counter()  # type: ignore
 
+	if info.get('probe', False):
+		base_url = os.path.splitext(info['first_url'])[0]
+		if (ext := await probe_ext(session, base_url)) is not None:
+			info = {
+				k: v
+				for k, v in info.items() if k != 'probe'
+			}
+			info['first_url'] = base_url + ext
+		else:
+			# e.g. original of ugoira is <id>_ugoira0.jpg, guessed info is replaced
+			logger.verbose(art_info.id, 'original not found, fetch info', progress=progress)
+			info = await fetch_info(session, art_info)
+			if 'error' in info:
+				logger.warn(art_info.id, 'error:', ERROR_MESSAGES[info['error']])
+				# counted as error, so artwork is not marked as completed
+				return Counter(error=1)
+		await cache.ainsert(SLUG, art_info.id, info, as_json=True)
+
 	# https://i.pximg.net/img-original/img/.../xxx_p0.png
 	base_url, ext = os.path.splitext(info['first_url'])
 	base_url = base_url[:-1]
@@ -100,6 +278,7 @@ async def download_art(
 	ind_range = art_info.range or range(total_imgs_count)
 
 	name_prefix = art_info.id + ' - ' + info['title']
+	tasks = []
 	for i in ind_range:
 		if i >= total_imgs_count:
 			# prevent range bigger than images count
@@ -113,25 +292,86 @@ async def download_art(
 
 		name = name_prefix + f'_p{i}' + ext
 		filename = os.path.join(save_folder, name)
-		if os.path.exists(filename):
+		page_id = f'{art_info.id}_p{i}'
+		if await ledger.exists(SLUG, page_id, filename):
 			logger.verbose('skip existing', *log_info, progress=progress)
 			stats.update(skip=1)
 			continue
 
-		logger.info('download', *log_info, progress=progress)
 		url = base_url + str(i) + ext
-		await download_binary(session, url, filename)
-		stats.update(download=1)
+		tasks.append(download_page(session, url, filename, page_id, art_info.id, log_info))
+
+	# pages are downloaded concurrently, number of downloads is limited in `download_binary`
+	for res in await gather(*tasks, return_exceptions=True):
+		if isinstance(res, Exception):
+			logger.warn(art_info.id, 'error:', res, progress=progress)
+			stats.update(error=1)
+		else:
+			stats.update(download=1)
 
 	return stats
 
 
+async def download_page(
+	session: ClientSession, url: str, filename: str, page_id: str, art_id: str, log_info: list
+):
+	""" Retry only this page on connection errors, with backoff """
+	for attempt in range(PAGE_RETRIES + 1):
+		try:
+			logger.info('download', *log_info, progress=progress)
+			await download_binary(
+				session, url, filename, site=SLUG, site_id=page_id, source=URL + art_id
+			)
+			return
+		except RETRY_ERRORS:
+			if attempt == PAGE_RETRIES:
+				raise
+
+			delay = RETRY_DELAY * 2**attempt
+			logger.info('error', page_id + ', retrying in', delay, 'seconds', progress=progress)
+			await sleep(delay)
+
+
+async def download_direct(session: ClientSession, parsed: Parsed, data_folder: str) -> Counter:
+	""" Download one page without fetching info, cached info is used for naming if it exists """
+	page = parsed.range[0]
+	ext = os.path.splitext(urlparse(parsed.direct).path)[1]
+	name = f'{parsed.id}_p{page}{ext}'
+	save_folder = data_folder
+
+	info = await cache.aselect(SLUG, parsed.id, as_json=True)
+	if info is not None and 'error' not in info:
+		name = parsed.id + ' - ' + info['title'] + f'_p{page}' + ext
+		save_folder = os.path.join(data_folder, info['artist'])
+	mkdir(save_folder)
+
+	filename = os.path.join(save_folder, name)
+	page_id = f'{parsed.id}_p{page}'
+	if await ledger.exists(SLUG, page_id, filename):
+		logger.verbose('skip existing', page_id, progress=progress)
+		return Counter(skip=1)
+
+	logger.info('download', page_id, progress=progress)
+	await download_binary(
+		session, parsed.direct, filename, site=SLUG, site_id=page_id, source=URL + parsed.id
+	)
+	return Counter(download=1)
+
+
 async def download(urls: list[str], data_folder: str):
 	stats = Counter()  # type: ignore
-	progress.total = len(urls)
+	progress.set(0, len(urls))
 
 	async with ProxyClientSession(headers=HEADERS) as session:
+		arts: list[str] = []
 		for url in urls:
+			if (user := parse_link(url).user) is not None:
+				arts.extend(await user_works_urls(session, user))
+			else:
+				arts.append(url)
+		progress.set(0, len(arts))
+
+		for url in arts:
 			progress.i += 1
 
 			parsed = parse_link(url)
@@ -140,32 +380,32 @@ async def download(urls: list[str], data_folder: str):
 				stats.update(skip=1)
 				continue
 
-			cached: dict = cache.select(SLUG, parsed.id, as_json=True)
-
-			if cached is None:
-				info = await fetch_info(session, parsed)
+			if parsed.direct is not None:
+				stats.update(await download_direct(session, parsed, data_folder))
+				ledger.complete(SLUG, url)
+				continue
 
+			info = await cache.fetch(
+				SLUG,
+				parsed.id,
+				partial(fetch_info, session, parsed),
 				# do not cache because it can be just wrong url, not deleted
-				if 'error' in info:
-					logger.warn(parsed.id, 'error:', ERROR_MESSAGES[info['error']])
-					stats.update(skip=1)
-					continue
-
-				cache.insert(SLUG, parsed.id, info, as_json=True)
-			else:
-				info = cached
+				cacheable=lambda i: 'error' not in i,
+			)
+			if 'error' in info:
+				logger.warn(parsed.id, 'error:', ERROR_MESSAGES[info['error']])
+				stats.update(skip=1)
+				continue
 
 			save_folder = os.path.join(data_folder, info['artist'])
 			mkdir(save_folder)
 
-			while True:
-				try:
-					dl_stats = await download_art(session, parsed, info, save_folder)
-					stats.update(dl_stats)
-					break
-				except ServerDisconnectedError:
-					logger.info('error, retrying in 5 seconds')
-					await sleep(5)
+			dl_stats = await download_art(session, parsed, info, save_folder)
+			stats.update(dl_stats)
+			if dl_stats['error'] == 0:
+				ledger.complete(SLUG, url)
+
+		await cache.revalidated()
 
 	logger.info(counter2str(stats))
 	logger.newline(normal=True)
@@ -1,11 +1,14 @@
 import os.path
+from asyncio import gather
 from collections import Counter, namedtuple
 from enum import Enum
 from typing import Any
 from urllib.parse import urlparse
 
 from art_dl.cache import cache
+from art_dl.ledger import ledger
 from art_dl.log import Logger, Progress
+from art_dl.utils.dispatch import dispatch
 from art_dl.utils.download import download_binary
 from art_dl.utils.path import filename_normalize, mkdir
 from art_dl.utils.print import counter2str
@@ -15,9 +18,19 @@ from art_dl.utils.retry import retry
 SLUG = 'reddit'
 
 JSON_URI = 'https://www.reddit.com/comments/{id}.json'
+POST_URI = 'https://www.reddit.com/comments/{id}'
+LISTING_URI = 'https://www.reddit.com/{listing}.json'
+# max number of posts in one listing page
+LISTING_LIMIT = 100
+BY_ID_URI = 'https://www.reddit.com/by_id/{names}.json'
+# max number of posts in one by_id request
+BY_ID_CHUNK = 100
 IMAGE_URI = 'https://i.redd.it/'
 
 DATA_CACHE_POSTFIX = ':data'
+# created time of newest post in listing is saved with this key,
+# next time listing is fetched until this post
+LISTING_CACHE_PREFIX = 'listing:'
 SKIP_CACHE_TAG = 'SKIP'
 
 REDDIT_DOMAINS = ('reddit.com', 'i.redd.it', 'v.redd.it')
@@ -25,7 +38,9 @@ REDDIT_DOMAINS = ('reddit.com', 'i.redd.it', 'v.redd.it')
 logger = Logger(prefix=[SLUG, 'download'], inline=True)
 progress = Progress()
 
-Parsed = namedtuple('Parsed', ['id'])
+# listing is a path of subreddit or user posts, e.g. r/<subreddit>/new,
+# media is a name of file for direct links
+Parsed = namedtuple('Parsed', ['id', 'listing', 'media'], defaults=[None, None, None])
 
 
 class DownloadResult(str, Enum):
@@ -37,6 +52,10 @@ def parse_link(url: str) -> Parsed:
 	parsed = urlparse(url)
 	path = parsed.path.lstrip('/').split('/')
 
+	if len(path) == 1 and parsed.netloc == 'i.redd.it':
+		# https://i.redd.it/<media id>.<ext>
+		return Parsed(media=path[0])
+
 	if len(path) == 1 and parsed.netloc == 'redd.it':
 		# https://redd.it/<id>
 		return Parsed(id=path[0])
@@ -50,16 +69,31 @@ def parse_link(url: str) -> Parsed:
 		# https://www.reddit.com/r/<subreddit>/comments/<id>/<any name>
 		return Parsed(id=path[3])
 
+	if len(path) >= 2 and path[0] == 'r':
+		# https://www.reddit.com/r/<subreddit>
+		return Parsed(listing=f'r/{path[1]}/new')
+
+	if len(path) >= 2 and path[0] in ('u', 'user') and path[2:3] in ([], [''], ['submitted']):
+		# https://www.reddit.com/user/<name>
+		# https://www.reddit.com/user/<name>/submitted
+		return Parsed(listing=f'user/{path[1]}/submitted')
+
 	return Parsed(id=None)
 
 
-async def fetch_data(session: ClientSession, url: str) -> Any:
-	async with session.get(url) as response:
-		response.raise_for_status()
-		data = (await response.json())[0]['data']['children'][0]['data']
+def canonical(url: str) -> str | None:
+	parsed = parse_link(url)
+	if parsed.listing is not None:
+		# names of subreddits and users are case-insensitive
+		return parsed.listing.lower()
+	if parsed.media is not None:
+		return os.path.splitext(parsed.media)[0]
+	return parsed.id
+
 
+def _parse_data(data: Any) -> Any:
 	media_metadata = data.get('media_metadata')
-	data = {
+	result = {
 		'domain': data['domain'],
 		'is_gallery': data.get('is_gallery', False),
 		'is_video': data['is_video'],
@@ -67,13 +101,99 @@ async def fetch_data(session: ClientSession, url: str) -> Any:
 		'title': data['title'],
 		'url': data['url'],
 	}
-	if data['is_gallery'] is True:
-		data['media_ext'] = {
+	if result['is_gallery'] is True:
+		result['media_ext'] = {
 			# info['m'] is mime type
 			media_id: info['m'].split('/')[1]
 			for media_id, info in media_metadata.items()
 		}
-	return data
+	return result
+
+
+async def fetch_data(session: ClientSession, url: str) -> Any:
+	async with session.get(url) as response:
+		response.raise_for_status()
+		data = (await response.json())[0]['data']['children'][0]['data']
+
+	return _parse_data(data)
+
+
+async def fetch_many(session: ClientSession, ids: list[str]) -> dict[str, Any]:
+	"""
+	Fetch data of posts by chunks, response contains only posts, without comments.
+	Deleted posts can be missed in result
+	"""
+	result = {}
+	for i in range(0, len(ids), BY_ID_CHUNK):
+		chunk = ids[i:i + BY_ID_CHUNK]
+		logger.verbose('fetch info', len(chunk), 'posts', progress=progress)
+
+		names = ','.join('t3_' + post_id for post_id in chunk)
+		async with session.get(BY_ID_URI.format(names=names)) as response:
+			response.raise_for_status()
+			children = (await response.json())['data']['children']
+
+		data = {
+			c['data']['id']: _parse_data(c['data'])
+			for c in children
+		}
+		await cache.ainsert_many(
+			SLUG, {
+				k + DATA_CACHE_POSTFIX: v
+				for k, v in data.items()
+			}, as_json=True
+		)
+		result.update(data)
+
+	return result
+
+
+async def fetch_listing(session: ClientSession, listing: str) -> tuple[dict[str, Any], float]:
+	"""
+	Fetch posts with media from listing, until post which was fetched on previous run.
+	Returns data of new posts by id and created time of newest post
+	"""
+	mark_key = LISTING_CACHE_PREFIX + listing.lower()
+	mark = await cache.aselect(SLUG, mark_key, as_json=True) or 0
+	newest = mark
+
+	params: dict[str, str | int] = {
+		'limit': LISTING_LIMIT,
+		'sort': 'new',
+	}
+	result: dict[str, Any] = {}
+	while True:
+		logger.info('fetch listing', listing, len(result), progress=progress)
+		async with session.get(LISTING_URI.format(listing=listing), params=params) as response:
+			response.raise_for_status()
+			page = (await response.json())['data']
+
+		reached = False
+		data = {}
+		for child in page['children']:
+			post = child['data']
+			# pinned posts are not sorted by time
+			if post['created_utc'] <= mark and not post.get('stickied', False):
+				reached = True
+				break
+
+			newest = max(newest, post['created_utc'])
+			if not post.get('is_self', False):
+				data[post['id']] = _parse_data(post)
+
+		await cache.ainsert_many(
+			SLUG, {
+				k + DATA_CACHE_POSTFIX: v
+				for k, v in data.items()
+			}, as_json=True
+		)
+		result.update(data)
+
+		if reached or page['after'] is None:
+			break
+		params['after'] = page['after']
+
+	return result, newest
 
 
 async def download_art(
@@ -82,59 +202,148 @@ async def download_art(
 	folder: str,
 	name: str,
 	log_name: str,
+	media_id: str,
+	source: str,
 ) -> DownloadResult:
 	filename = os.path.join(folder, name)
-	if os.path.exists(filename):
+	if await ledger.exists(SLUG, media_id, filename):
 		logger.info('skip existing', log_name, progress=progress)
 		return DownloadResult.skip
 
 	logger.info('download', log_name, progress=progress)
-	await download_binary(session, url, filename)
+	await download_binary(session, url, filename, site=SLUG, site_id=media_id, source=source)
 	return DownloadResult.download
 
 
+async def download_gallery(
+	session: ClientSession, data: Any, post_id: str, folder: str, source: str
+) -> Counter:
+	""" Download images concurrently, number of failed images is in `error` """
+	count = len(data['media_ext'])
+	tasks = []
+	for i, (media_id, ext) in enumerate(data['media_ext'].items()):
+		url_filename = media_id + '.' + ext
+		tasks.append(
+			download_art(
+				session,
+				IMAGE_URI + url_filename,
+				folder,
+				url_filename,
+				f'{post_id}/{media_id} - {i + 1}/{count}',
+				media_id,
+				source,
+			)
+		)
+
+	stats = Counter()  # type: ignore
+	for res in await gather(*tasks, return_exceptions=True):
+		if isinstance(res, BaseException):
+			logger.verbose('error in gallery', post_id + ':', res, progress=progress)
+			stats.update(error=1)
+		else:
+			stats.update({
+				res.value: 1
+			})
+	return stats
+
+
 async def download(urls: list[str], data_folder: str):
 	stats = Counter()  # type: ignore
-	progress.total = len(urls)
+	progress.set(0, len(urls))
 
 	sep = ' - '
 
 	async with ProxyClientSession() as session:
+		# { '<id>': <data> }
+		fetched: dict[str, Any] = {}
+		# { '<listing>': <created time of newest post> }
+		marks: dict[str, float] = {}
+		# { '<id>': '<listing>' }, for posts from listings
+		post_listing: dict[str, str] = {}
+		posts: list[str] = []
 		for url in urls:
+			parsed = parse_link(url)
+			if parsed.listing is None:
+				posts.append(url)
+				continue
+
+			listing_data, marks[parsed.listing] = await fetch_listing(session, parsed.listing)
+			logger.info('new posts in', parsed.listing + ':', len(listing_data), progress=progress)
+			fetched.update(listing_data)
+			post_listing.update((post_id, parsed.listing) for post_id in listing_data)
+			posts.extend(POST_URI.format(id=post_id) for post_id in listing_data)
+		progress.total = len(posts)
+
+		# { '<id>': <cached tag> }
+		tags: dict[str, Any] = {}
+		for url in posts:
+			parsed = parse_link(url)
+			if parsed.id is not None:
+				tags[parsed.id] = await cache.aselect(SLUG, parsed.id)
+
+		# data of not processed posts is fetched in batches
+		to_fetch = [k for k, tag in tags.items() if tag is None and k not in fetched]
+		fetched.update(await fetch_many(session, to_fetch))
+
+		for url in posts:
 			progress.i += 1
 
 			parsed = parse_link(url)
 
+			if parsed.media is not None:
+				# direct link, title of post is not known, so it's saved with name of file
+				mkdir(data_folder)
+				res = await download_art(
+					session,
+					IMAGE_URI + parsed.media,
+					data_folder,
+					parsed.media,
+					parsed.media,
+					os.path.splitext(parsed.media)[0],
+					url,
+				)
+				stats.update({
+					res.value: 1
+				})
+				ledger.complete(SLUG, url)
+				continue
+
 			if parsed.id is None:
 				logger.warn('unsupported link', url, progress=progress)
 				stats.update(skip=1)
 				continue
 
-			cached = cache.select(SLUG, parsed.id)
+			cached = tags[parsed.id]
 
 			if cached == SKIP_CACHE_TAG:
 				logger.verbose('skip', url, progress=progress)
 				stats.update(skip_video=1)
 				continue
 
-			if cached is None:
+			data = None
+			if cached is not None:
+				# data can be evicted from cache without tag, then it's fetched again
+				data = await cache.aselect(SLUG, parsed.id + DATA_CACHE_POSTFIX, as_json=True)
+			if data is None and (data := fetched.get(parsed.id)) is None:
+				# not returned in batch, this request shows error
 				data = await fetch_data(session, JSON_URI.format(id=parsed.id))
-				cache.insert(SLUG, parsed.id + DATA_CACHE_POSTFIX, data, as_json=True)
-			else:
-				data = cache.select(SLUG, parsed.id + DATA_CACHE_POSTFIX, as_json=True)
+				await cache.ainsert(SLUG, parsed.id + DATA_CACHE_POSTFIX, data, as_json=True)
 
 			domain = data['domain']
 			if domain not in REDDIT_DOMAINS:
 				logger.warn('media is from', domain, url + ':', data['url'], progress=progress)
-				if domain == 'imgur.com':
-					retry.add(data['url'])
-					stats.update(will_retry=1)
-				elif domain == 'i.imgur.com':
-					imgur_id, _ = os.path.splitext(data['url'].split('/')[-1])
-					retry.add('https://imgur.com/' + imgur_id)
-					stats.update(will_retry=1)
-				else:
+				external_url = None
+				if domain in ('imgur.com', 'i.imgur.com'):
+					# link to file is downloaded by imgur without api request
+					external_url = data['url']
+
+				if external_url is None:
 					stats.update(skip=1)
+				elif await dispatch.forward(external_url):
+					stats.update(forward=1)
+				else:
+					await retry.aadd(external_url)
+					stats.update(will_retry=1)
 				continue
 
 			save_folder = os.path.join(data_folder, data['subreddit'])
@@ -146,36 +355,52 @@ async def download(urls: list[str], data_folder: str):
 				folder = os.path.join(save_folder, title)
 				mkdir(folder)
 
-				i = 0
-				for media_id, ext in data['media_ext'].items():
-					url_filename = media_id + '.' + ext
-					url = IMAGE_URI + url_filename
-					res = await download_art(
-						session, url, folder, url_filename, f'{parsed.id}/{media_id} - {i}'
+				gallery_stats = await download_gallery(session, data, parsed.id, folder, url)
+				stats.update(gallery_stats)
+				if gallery_stats['error'] > 0:
+					# tag is not saved, so gallery is resumed next time
+					logger.warn(
+						'failed', gallery_stats['error'], 'images in', url, progress=progress
 					)
-					stats.update({res.value: 1})
-					i += 1
+					# listing should be fetched again next time
+					if (listing := post_listing.get(parsed.id)) is not None:
+						marks.pop(listing, None)
+					continue
 
 				if cached is None:
-					cache.insert(SLUG, parsed.id, 'gallery')
+					await cache.ainsert(SLUG, parsed.id, 'gallery')
 			elif data['is_video'] is True:
 				logger.verbose('skip video', url, progress=progress)
-				cache.insert(SLUG, parsed.id, SKIP_CACHE_TAG)
-				cache.delete(SLUG, parsed.id + DATA_CACHE_POSTFIX)
+				await cache.ainsert(SLUG, parsed.id, SKIP_CACHE_TAG)
+				await cache.adelete(SLUG, parsed.id + DATA_CACHE_POSTFIX)
 				stats.update(skip_video=1)
 			else:
-				url = data['url']
-				url_filename = urlparse(url).path.lstrip('/')
-				if cached is None:
-					cache.insert(SLUG, parsed.id, 'image')
+				media_url = data['url']
+				url_filename = urlparse(media_url).path.lstrip('/')
 
 				media_id, ext = os.path.splitext(url_filename)
 				filename = sep.join((title, media_id)) + ext
 				mkdir(save_folder)
 				res = await download_art(
-					session, url, save_folder, filename, f'{parsed.id}/{media_id}'
+					session,
+					media_url,
+					save_folder,
+					filename,
+					f'{parsed.id}/{media_id}',
+					media_id,
+					url,
 				)
-				stats.update({res.value: 1})
+				stats.update({
+					res.value: 1
+				})
+				if cached is None:
+					await cache.ainsert(SLUG, parsed.id, 'image')
+
+			ledger.complete(SLUG, url)
+
+	# save after download, so posts are not lost if download is interrupted
+	for listing, mark in marks.items():
+		await cache.ainsert(SLUG, LISTING_CACHE_PREFIX + listing.lower(), mark, as_json=True)
 
 	logger.info(counter2str(stats))
 	logger.newline(normal=True)
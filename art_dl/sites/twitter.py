@@ -1,36 +1,38 @@
 import os.path
+from asyncio import TimeoutError
 from collections import Counter, namedtuple
 from enum import Enum
+from functools import partial
 from urllib.parse import unquote, urljoin, urlparse
 
-from aiohttp import ClientTimeout
-from aiohttp.client_exceptions import ServerTimeoutError
-from lxml import etree
+from aiohttp import ClientError, ClientTimeout
 
 from art_dl.cache import cache
+from art_dl.ledger import ledger
 from art_dl.log import Logger, Progress
-from art_dl.utils.download import download_binary
+from art_dl.utils.download import read_binary, save_binary
+from art_dl.utils.html import Extractor, Selector
+from art_dl.utils.instances import InstancePool
 from art_dl.utils.path import filename_normalize, filename_shortening, mkdir
 from art_dl.utils.print import counter2str
 from art_dl.utils.proxy import ClientSession, ProxyClientSession
 
 SLUG = 'twitter'
+TWITTER_URL = 'https://twitter.com'
 
-BASE_URL = 'https://nitter.net'
 # https://github.com/libredirect/libredirect/blob/master/src/instances/data.json
 # except https://github.com/libredirect/libredirect/blob/master/src/instances/blacklist.json
-FALLBACK_URLS = (
+INSTANCES = (
+	'https://nitter.net',
 	'https://nitter.42l.fr',
 	'https://nitter.pussthecat.org',
 	'https://nitter.fdn.fr',
 	'https://nitter.1d4.us',
 	'https://nitter.kavin.rocks',
 	'https://nitter.unixfox.eu',
-	# return to default
-	'https://nitter.net',
 )
-# ind in FALLBACK_URLS
-CURRENT_URL_IND = -1
+# max number of instances used for one request
+FAILOVER_BUDGET = 3
 
 COOKIES = {
 	# hide replies and images in replies
@@ -43,28 +45,37 @@ HEADERS = {
 	'User-Agent': 'Mozilla/5.0'
 }
 SESSION_TIMEOUT = ClientTimeout(sock_read=10)
-
-Parsed = namedtuple('Parsed', ['id', 'account', 'path'], defaults=[None, None, None])
+# id of newest tweet in timeline is saved with this key,
+# next time timeline is fetched until this tweet
+TIMELINE_CACHE_PREFIX = 'timeline:'
+# errors after all instances from failover budget
+REQUEST_ERRORS = (ClientError, TimeoutError, ValueError)
+
+# media is set for links to media timeline of account
+Parsed = namedtuple(
+	'Parsed', ['id', 'account', 'path', 'media'], defaults=[None, None, None, False]
+)
 
 logger = Logger(prefix=[SLUG, 'download'], inline=True)
 progress = Progress()
 
+TWEET_EXTRACTOR = Extractor(
+	'nitter tweet', [
+		Selector('description', '//meta[@property=\'og:description\']/@content'),
+		Selector(
+			'images',
+			'//div[@class="attachments"]/div/div[@class="attachment image"]/a/@href',
+			many=True,
+		),
+	]
+)
+
 
 class DownloadResult(str, Enum):
 	download = 'download'
 	skip = 'skip'
 
 
-def switch_instance():
-	global BASE_URL
-	global CURRENT_URL_IND
-
-	CURRENT_URL_IND = (CURRENT_URL_IND + 1) % len(FALLBACK_URLS)
-	BASE_URL = FALLBACK_URLS[CURRENT_URL_IND]
-
-	logger.warn('connect timeout, switching instance to', BASE_URL)
-
-
 def parse_link(url: str) -> Parsed:
 	parsed = urlparse(url)
 	original_path = parsed.path
@@ -74,25 +85,67 @@ def parse_link(url: str) -> Parsed:
 		# https://(mobile.)twitter.com/<account>/status/<id>
 		return Parsed(path[2], path[0], original_path)
 
+	if len(path) == 2 and path[1] == 'media':
+		# https://twitter.com/<account>/media
+		return Parsed(account=path[0], path=original_path, media=True)
+
 	return Parsed()
 
 
-async def fetch_info(session: ClientSession, parsed: Parsed):
-	logger.info('fetch info', f'{parsed.account}/{parsed.id}', progress=progress)
-	try:
-		# wait for api: https://github.com/zedeus/nitter/issues/192
-		async with session.get(urljoin(BASE_URL, parsed.path)) as response:
-			data = await response.text()
-	except ServerTimeoutError:
-		switch_instance()
-		return await fetch_info(session, parsed)
-
-	root = etree.HTML(data)
-	description = root.xpath('//meta[@property=\'og:description\']/@content')[0]
-	images_urls = root.xpath(
-		'//div[@class="attachments"]/div/div[@class="attachment image"]/a/@href'
-	)
+def canonical(url: str) -> str | None:
+	parsed = parse_link(url)
+	if parsed.media:
+		return 'media/' + parsed.account.lower()
+	# tweet id is unique, account name can be changed
+	return parsed.id
+
+
+def _timeline_items(elements: list) -> list[dict]:
+	""" Tweets from timeline page, it's called in parser thread """
+	items = []
+	for e in elements:
+		links = e.xpath('.//a[@class="tweet-link"]/@href')
+		if len(links) == 0:
+			continue
+
+		# /<account>/status/<id>#m
+		path = urlparse(links[0]).path
+		account, _, tweet_id = path.lstrip('/').split('/')[:3]
+		items.append({
+			'id': tweet_id,
+			'account': account,
+			'path': path,
+			'pinned': len(e.xpath('.//div[@class="pinned"]')) > 0,
+			'description': e.xpath('string(.//div[contains(@class, "tweet-content")])').strip(),
+			'images': [str(i) for i in e.xpath('.//div[@class="attachment image"]/a/@href')],
+		})
+	return items
+
+
+TIMELINE_EXTRACTOR = Extractor(
+	'nitter timeline', [
+		Selector(
+			'items', '//div[contains(@class, "timeline-item")]', many=True, convert=_timeline_items
+		),
+		Selector('more', '//div[contains(@class, "show-more")]/a/@href', many=True),
+	]
+)
+
+
+async def _fetch_page(session: ClientSession, path: str, base_url: str) -> tuple[str, list[str]]:
+	# wait for api: https://github.com/zedeus/nitter/issues/192
+	async with session.get(urljoin(base_url, path)) as response:
+		response.raise_for_status()
+		data = await response.read()
 
+	# parsed here, so broken page of instance is the same error as timeout
+	result = await TWEET_EXTRACTOR.extract(data)
+	if result['description'] is None:
+		raise ValueError('no tweet on page')
+	return result['description'], result['images']
+
+
+def _info(description: str, images_urls: list[str]) -> dict:
 	return {
 		'description': description,
 		# save original url (non unquoted) bc when make request like /pic/media/...?name=orig
@@ -106,33 +159,122 @@ async def fetch_info(session: ClientSession, parsed: Parsed):
 	}
 
 
+async def fetch_info(session: ClientSession, pool: InstancePool, parsed: Parsed):
+	logger.info('fetch info', f'{parsed.account}/{parsed.id}', progress=progress)
+	description, images_urls = await pool.request(partial(_fetch_page, session, parsed.path))
+	return _info(description, images_urls)
+
+
+async def _fetch_timeline_page(session: ClientSession, path: str, base_url: str) -> dict:
+	async with session.get(urljoin(base_url, path)) as response:
+		response.raise_for_status()
+		data = await response.read()
+
+	result = await TIMELINE_EXTRACTOR.extract(data)
+	if len(result['items']) == 0 and len(result['more']) == 0:
+		raise ValueError('no timeline on page')
+	return result
+
+
+async def fetch_timeline(session: ClientSession, pool: InstancePool,
+							parsed: Parsed) -> tuple[list[str], int]:
+	"""
+	Fetch tweets with images from media timeline, until tweet which was fetched on previous run.
+	Info of tweets is saved to cache. Returns links to new tweets and id of newest tweet
+	"""
+	mark_key = TIMELINE_CACHE_PREFIX + parsed.account.lower()
+	mark = await cache.aselect(SLUG, mark_key, as_json=True) or 0
+	newest = mark
+
+	urls: list[str] = []
+	path = parsed.path
+	while True:
+		logger.info('fetch timeline', parsed.account, len(urls), progress=progress)
+		page = await pool.request(partial(_fetch_timeline_page, session, path))
+
+		reached = False
+		infos = {}
+		for item in page['items']:
+			tweet_id = int(item['id'])
+			# pinned tweet is not sorted by time
+			if tweet_id <= mark and not item['pinned']:
+				reached = True
+				break
+
+			newest = max(newest, tweet_id)
+			if len(item['images']) > 0:
+				key = item['account'] + ':' + item['id']
+				infos[key] = _info(item['description'], item['images'])
+				urls.append(TWITTER_URL + item['path'])
+
+		await cache.ainsert_many(SLUG, infos, as_json=True)
+
+		# first "show more" is link to newest tweets on next pages
+		more = [m for m in page['more'] if 'cursor=' in m]
+		if reached or len(page['items']) == 0 or len(more) == 0:
+			break
+		path = parsed.path + more[-1]
+
+	return urls, newest
+
+
+async def _read_image(session: ClientSession, path: str, base_url: str) -> tuple[str, bytes]:
+	url = urljoin(base_url, path)
+	# losing hedged request is cancelled
+	return url, await read_binary(session, url, shared=False)
+
+
 async def download_image(
-	session: ClientSession, url: str, save_folder: str, name: str, log_info: str
+	session: ClientSession,
+	pool: InstancePool,
+	url: str,
+	save_folder: str,
+	name: str,
+	log_info: str,
+	image_id: str,
+	source: str,
 ) -> DownloadResult:
 	filename = os.path.join(save_folder, name)
-	if os.path.exists(filename):
+	if await ledger.exists(SLUG, image_id, filename):
 		logger.verbose('skip existing', log_info, progress=progress)
 		return DownloadResult.skip
 
 	logger.info('download', log_info, progress=progress)
-	try:
-		await download_binary(session, urljoin(BASE_URL, url), filename)
-	except ServerTimeoutError:
-		switch_instance()
-		return await download_image(session, url, save_folder, name, log_info)
-
+	full_url, data = await pool.request(partial(_read_image, session, url), 'image')
+	await save_binary(data, full_url, filename, site=SLUG, site_id=image_id, source=source)
 	return DownloadResult.download
 
 
 async def download(urls: list[str], data_folder: str):
 	stats = Counter()  # type: ignore
-	progress.total = len(urls)
+	progress.set(0, len(urls))
 	sep = ' - '
 
 	async with ProxyClientSession(
 		cookies=COOKIES, timeout=SESSION_TIMEOUT, headers=HEADERS
 	) as session:
+		pool = InstancePool(INSTANCES, FAILOVER_BUDGET)
+
+		tweets: list[str] = []
+		# { '<account>': <id of newest tweet> }
+		marks: dict[str, int] = {}
 		for url in urls:
+			parsed = parse_link(url)
+			if not parsed.media:
+				tweets.append(url)
+				continue
+
+			try:
+				timeline, mark = await fetch_timeline(session, pool, parsed)
+			except REQUEST_ERRORS as e:
+				logger.warn(f'{parsed.account}/media: error:', e, progress=progress)
+				stats.update(error=1)
+				continue
+			marks[parsed.account.lower()] = mark
+			tweets.extend(await ledger.filter_completed(SLUG, timeline))
+		progress.set(0, len(tweets))
+
+		for url in tweets:
 			progress.i += 1
 
 			parsed = parse_link(url)
@@ -142,16 +284,25 @@ async def download(urls: list[str], data_folder: str):
 				continue
 
 			cache_key = parsed.account + ':' + parsed.id
-			cached: dict = cache.select(SLUG, cache_key, as_json=True)
+			cached: dict = await cache.aselect(SLUG, cache_key, as_json=True)
 
 			if cached is None:
-				info = await fetch_info(session, parsed)
+				try:
+					info = await fetch_info(session, pool, parsed)
+				except REQUEST_ERRORS as e:
+					logger.warn(f'{parsed.account}/{parsed.id}: error:', e, progress=progress)
+					stats.update(error=1)
+					# timeline should be fetched again next time
+					marks.pop(parsed.account.lower(), None)
+					continue
 				if info['count'] == 0:
-					logger.warn(f'{parsed.account}/{parsed.id}: tweet without images. try again if this is an error')
+					logger.warn(
+						f'{parsed.account}/{parsed.id}: tweet without images. try again if this is an error'
+					)
 					stats.update(skip=1)
 					continue
 
-				cache.insert(SLUG, cache_key, info, as_json=True)
+				await cache.ainsert(SLUG, cache_key, info, as_json=True)
 			else:
 				info = cached
 
@@ -163,17 +314,41 @@ async def download(urls: list[str], data_folder: str):
 			save_folder = os.path.join(data_folder, parsed.account)
 			mkdir(save_folder)
 
+			failed = False
 			i = 0
 			for image in info['images']:
 				filename = (title_prefix + sep + str(i)) if add_index else title_prefix
 				filename += image['ext']
+				image_id = f'{parsed.account}/{parsed.id}/{i}'
 				i += 1
 
 				log_info = f'{parsed.account}/{parsed.id}'
 				if add_index:
 					log_info += sep + str(i)
-				res = await download_image(session, image['url'], save_folder, filename, log_info)
-				stats.update({res.value: 1})
+				try:
+					res = await download_image(
+						session, pool, image['url'], save_folder, filename, log_info, image_id, url
+					)
+				except REQUEST_ERRORS as e:
+					logger.warn(log_info, 'error:', e, progress=progress)
+					stats.update(error=1)
+					failed = True
+					continue
+				stats.update({
+					res.value: 1
+				})
+
+			if not failed:
+				ledger.complete(SLUG, url)
+			else:
+				marks.pop(parsed.account.lower(), None)
+
+		for account, mark in marks.items():
+			await cache.ainsert(SLUG, TIMELINE_CACHE_PREFIX + account, mark, as_json=True)
+
+		for instance_url, p90, requests, errors in pool.stats():
+			if requests > 0:
+				logger.verbose(instance_url, 'requests:', requests, 'errors:', errors, 'p90:', p90)
 
 	logger.info(counter2str(stats))
 	logger.newline(normal=True)
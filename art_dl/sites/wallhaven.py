@@ -2,14 +2,19 @@ import os.path
 from asyncio import sleep
 from collections import Counter, namedtuple
 from enum import Enum
-from glob import glob
 from typing import Any, Tuple
-from urllib.parse import urlparse
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+from aiohttp import ClientError
 
 from art_dl.cache import cache
+from art_dl.ledger import ledger
 from art_dl.log import Logger, Progress
+from art_dl.utils.config import config
 from art_dl.utils.credentials import creds
 from art_dl.utils.download import download_binary
+from art_dl.utils.file_index import file_index, name_prefix
+from art_dl.utils.limit import RateLimiter
 from art_dl.utils.path import filename_normalize, filename_shortening, mkdir
 from art_dl.utils.print import counter2str
 from art_dl.utils.proxy import ClientSession, ProxyClientSession
@@ -17,10 +22,17 @@ from art_dl.utils.proxy import ClientSession, ProxyClientSession
 SLUG = 'wallhaven'
 CREDS_PATH = [SLUG, 'api_key']
 
-API_URL = 'https://wallhaven.cc/api/v1/w/'
+API_URL = 'https://wallhaven.cc/api/v1/'
+WALLPAPER_URL = 'https://wallhaven.cc/w/'
+# https://wallhaven.cc/help/api: 45 requests per minute,
+# limit is the same with and without api key
+API_RATE_LIMIT = 45
+# tags are not returned in listings, so each wallpaper needs one more request for them
+TAGS_CONFIG = 'wallhaven_tags'
 
 logger = Logger(prefix=[SLUG, 'download'], inline=True)
 progress = Progress()
+api_limiter = RateLimiter(API_RATE_LIMIT, 60)
 
 
 class FetchDataAction(Enum):
@@ -29,20 +41,69 @@ class FetchDataAction(Enum):
 	skip = 2
 
 
-Parsed = namedtuple('Parsed', ['id'])
+# listing is api path of search or collection, params are params of search
+Parsed = namedtuple('Parsed', ['id', 'listing', 'params'], defaults=[None, None, None])
 
 
 def parse_link(url: str):
 	parsed = urlparse(url)
 	path = parsed.path.lstrip('/').split('/')
 
-	if parsed.netloc == 'wallhaven.cc':
-		# https://wallhaven.cc/w/<id>
-		# strip 'w'
-		path.pop(0)
+	if parsed.netloc != 'wallhaven.cc':
+		# https://whvn.cc/<id>
+		return Parsed(path[0])
+
+	if path[0] == 'search':
+		# https://wallhaven.cc/search?q=<query>&<other params>
+		params = {
+			k: v
+			for k, v in parse_qsl(parsed.query) if k != 'page'
+		}
+		return Parsed(listing='search', params=params)
+
+	if path[0] == 'tag' and len(path) > 1:
+		# https://wallhaven.cc/tag/<id>
+		return Parsed(listing='search', params={
+			'q': 'id:' + path[1]
+		})
+
+	if path[0] == 'user' and len(path) > 3 and path[2] == 'favorites':
+		# https://wallhaven.cc/user/<name>/favorites/<id>
+		return Parsed(listing=f'collections/{path[1]}/{path[3]}', params={})
+
+	# https://wallhaven.cc/w/<id>
+	return Parsed(path[1] if len(path) > 1 else None)
+
 
-	# https://whvn.cc/<id>
-	return Parsed(path[0])
+def canonical(url: str) -> str | None:
+	parsed = parse_link(url)
+	if parsed.listing is not None and len(parsed.params) > 0:
+		return parsed.listing + '?' + urlencode(sorted(parsed.params.items()))
+	if parsed.listing is not None:
+		return parsed.listing
+	return parsed.id or None
+
+
+def tags_in_filenames() -> bool:
+	return config.get(TAGS_CONFIG, 'y').lower() not in ('n', 'no')
+
+
+async def _get(session: ClientSession, url: str, params: dict) -> tuple[int, Any]:
+	""" Request to api, returns status and json. Waits for rate limit """
+	# loop for retrying on rate limit
+	while True:
+		await api_limiter.wait()
+		async with session.get(url, params=params) as response:
+			if response.status == 429:
+				# should not happen, but limit can be shared with other clients
+				logger.info('to many requests, sleeping for 10 seconds', progress=progress)
+				await sleep(10)
+				continue
+			elif response.status == 401:
+				return response.status, None
+
+			response.raise_for_status()
+			return response.status, await response.json()
 
 
 async def fetch_data(
@@ -52,70 +113,117 @@ async def fetch_data(
 	with_key: bool,
 	has_api_key: bool,
 ) -> Tuple[Any, FetchDataAction]:
-	# loop for retrying on rate limit
+	status, data = await _get(session, API_URL + 'w/' + img_id, params)
+	if status == 401:
+		if with_key:
+			logger.warn('invalid api_key, skip')
+			return None, FetchDataAction.skip
+
+		if has_api_key:
+			logger.verbose('queueing NSFW', img_id)
+			return None, FetchDataAction.retry_with_key
+
+		logger.warn('skip NSFW', img_id, '(api_key not present)')
+		return None, FetchDataAction.skip
+
+	data = data['data']
+	data = {
+		'id': data['id'],
+		'path': data['path'],
+		'tags': list(t['name'] for t in data['tags'])
+	}
+	return data, FetchDataAction.download
+
+
+async def fetch_listing(session: ClientSession, parsed: Parsed, params: dict) -> list[dict]:
+	""" Fetch all pages of search or collection, returns ids and paths of wallpapers """
+	result: list[dict] = []
+	page = 1
 	while True:
-		async with session.get(API_URL + img_id, params=params) as response:
-			if response.status == 429:
-				logger.info('to many requests, sleeping for 10 seconds', progress=progress)
-				await sleep(10)
-				continue
-			elif response.status == 401:
-				if with_key:
-					logger.warn('invalid api_key, skip')
-					return None, FetchDataAction.skip
-
-				if has_api_key:
-					logger.verbose('queueing NSFW', img_id)
-					return None, FetchDataAction.retry_with_key
-
-				logger.warn('skip NSFW', img_id, '(api_key not present)')
-				return None, FetchDataAction.skip
-
-			data = (await response.json())['data']
-			data = {
-				'id': data['id'],
-				'path': data['path'],
-				'tags': list(t['name'] for t in data['tags'])
+		logger.info('fetch', parsed.listing, 'page', page, progress=progress)
+		status, data = await _get(
+			session, API_URL + parsed.listing, {
+				**parsed.params,
+				**params, 'page': page
 			}
-			return data, FetchDataAction.download
+		)
+		if status == 401:
+			logger.warn('invalid api_key or private collection, skip', parsed.listing)
+			return result
 
+		result.extend({
+			'id': w['id'],
+			'path': w['path']
+		} for w in data['data'])
+		if page >= data['meta']['last_page']:
+			return result
+		page += 1
 
-async def download(urls: list[str], data_folder: str, with_key=False):
+
+async def download(urls: list[str], data_folder: str):
 	mkdir(data_folder)
 
 	stats = Counter()  # type: ignore
 	progress.set(0, len(urls))
 
-	retry_with_key = []
-
 	api_key = creds.get(CREDS_PATH)
 	has_api_key = api_key is not None
-	params = {}
-	if with_key:
-		if has_api_key:
-			logger.info('using api_key', end='\n')
-			params = {
-				'apikey': api_key
-			}
-		else:
-			logger.warn('you should add api_key')
-			return
+	key_params = {
+		'apikey': api_key
+	} if has_api_key else {}
+	with_tags = tags_in_filenames()
+	# [('<url>', <request with key>)], NSFW arts are added to the end of queue to retry with key
+	queue: list[tuple[str, bool]] = []
+	retry_with_key: set[str] = set()
+	# { '<id>': { 'id': '<id>', 'path': '<url>' } }, wallpapers from listings
+	listed: dict[str, dict] = {}
+
+	existing_files = file_index.get(data_folder, name_prefix)
 
 	async with ProxyClientSession() as session:
 		for url in urls:
+			parsed = parse_link(url)
+			if parsed.listing is None:
+				queue.append((url, False))
+				continue
+
+			try:
+				# listing has NSFW wallpapers only with key
+				items = await fetch_listing(session, parsed, key_params)
+			except ClientError as e:
+				logger.warn(parsed.listing, 'error:', e, progress=progress)
+				stats.update(error=1)
+				continue
+
+			if not with_tags:
+				# path is already known, so wallpaper does not need request
+				listed.update((i['id'], i) for i in items)
+			items_urls = await ledger.filter_completed(
+				SLUG, [WALLPAPER_URL + i['id'] for i in items]
+			)
+			# listing was requested with key, so NSFW wallpapers from it need key too
+			queue.extend((u, has_api_key) for u in items_urls)
+		progress.set(0, len(queue))
+
+		# queue can grow while iterating
+		for url, with_key in queue:
 			progress.i += 1
 			should_skip = False
 
 			parsed = parse_link(url)
-			existing = glob(f'{data_folder}/{parsed.id} - *.*')
-			if len(existing) == 1:
+			existing = existing_files.find(parsed.id)
+			if await ledger.has(SLUG, parsed.id):
+				logger.verbose('skip downloaded', parsed.id)
+				should_skip = True
+			elif len(existing) == 1:
 				logger.verbose('skip existing', parsed.id)
+				ledger.complete(SLUG, url)
 				should_skip = True
 			elif len(existing) > 1:
 				logger.warn('duplicated files for art', parsed.id)
 				should_skip = True
 
-			if url in retry_with_key:
+			if not with_key and url in retry_with_key:
 				logger.verbose('duplicate link', url)
 				should_skip = True
 
@@ -123,40 +231,46 @@ async def download(urls: list[str], data_folder: str, with_key=False):
 				stats.update(skip=1)
 				continue
 
-			cached = cache.select(SLUG, parsed.id, as_json=True)
+			cached = await cache.aselect(SLUG, parsed.id, as_json=True) or listed.get(parsed.id)
 
 			if cached is None:
+				params = key_params if with_key else {}
 				data, action = await fetch_data(session, parsed.id, params, with_key, has_api_key)
 
 				if action == FetchDataAction.retry_with_key:
 					stats.update(will_retry=1)
-					retry_with_key.append(url)
+					if url not in retry_with_key:
+						retry_with_key.add(url)
+						queue.append((url, True))
+						progress.total += 1
 				elif action == FetchDataAction.skip:
 					stats.update(skip=1)
 				if action != FetchDataAction.download:
 					continue
 
-				cache.insert(SLUG, parsed.id, data, as_json=True)
+				await cache.ainsert(SLUG, parsed.id, data, as_json=True)
 			else:
 				data = cached
 
 			logger.info('download', data['id'], progress=progress)
 
 			full_url = data['path']
-			name = data['id'] + ' - ' + ', '.join(data['tags'])
+			name = data['id']
+			if with_tags:
+				name += ' - ' + ', '.join(data['tags'])
 			name = filename_normalize(name) + os.path.splitext(full_url)[1]
 			name = filename_shortening(name, with_ext=True)
 			filename = os.path.join(data_folder, name)
 
-			await download_binary(session, full_url, filename)
+			await download_binary(
+				session, full_url, filename, site=SLUG, site_id=data['id'], source=url
+			)
+			ledger.complete(SLUG, url)
 			stats.update(download=1)
 
 	logger.info(counter2str(stats))
 	logger.newline(normal=True)
 
-	if len(retry_with_key) > 0:
-		return await download(retry_with_key, data_folder, True)
-
 
 def register():
 	"""Ask key"""
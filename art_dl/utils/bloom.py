@@ -0,0 +1,93 @@
+"""
+Persistent bloom filter stored in memory-mapped file.
+
+File layout: header (magic, format version, size in bits, number of hashes, count of added keys)
+and bit array. If file has another parameters, it's recreated
+"""
+
+import mmap
+import os
+from hashlib import blake2b
+from math import ceil, log
+from struct import Struct
+
+_MAGIC = b'ADBF'
+_VERSION = 1
+_HEADER = Struct('>4sBQBQ')
+
+
+def _params(capacity: int, error_rate: float) -> tuple[int, int]:
+	""" Returns size in bits and number of hashes """
+	bits = ceil(-capacity * log(error_rate) / log(2)**2)
+	hashes = max(1, round(bits / capacity * log(2)))
+	return bits, hashes
+
+
+class BloomFilter:
+	"""
+	Probabilistic set: `key in filter` can be a false positive,
+	but never a false negative
+	"""
+
+	def __init__(self, filename: str, capacity: int, error_rate: float) -> None:
+		self.bits, self.hashes = _params(capacity, error_rate)
+		self.capacity = capacity
+		size = _HEADER.size + ceil(self.bits / 8)
+
+		self._file = open(filename, 'r+b' if os.path.exists(filename) else 'w+b')
+		self.created = not self._is_compatible(size)
+		if self.created:
+			self._file.truncate(0)
+			# file is sparse, so it does not take all space until filled
+			self._file.truncate(size)
+			self._file.seek(0)
+			self._file.write(_HEADER.pack(_MAGIC, _VERSION, self.bits, self.hashes, 0))
+			self._file.flush()
+
+		self._mmap = mmap.mmap(self._file.fileno(), size)
+
+	def _is_compatible(self, size: int) -> bool:
+		if os.fstat(self._file.fileno()).st_size != size:
+			return False
+
+		self._file.seek(0)
+		magic, version, bits, hashes, _ = _HEADER.unpack(self._file.read(_HEADER.size))
+		return (magic, version, bits, hashes) == (_MAGIC, _VERSION, self.bits, self.hashes)
+
+	@property
+	def count(self) -> int:
+		return _HEADER.unpack_from(self._mmap)[4]
+
+	def _set_count(self, count: int):
+		_HEADER.pack_into(self._mmap, 0, _MAGIC, _VERSION, self.bits, self.hashes, count)
+
+	def _positions(self, key: str):
+		digest = blake2b(key.encode(), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:], 'little') | 1
+		for i in range(self.hashes):
+			yield (h1 + i * h2) % self.bits
+
+	def add(self, key: str):
+		added = False
+		for pos in self._positions(key):
+			byte, bit = _HEADER.size + pos // 8, 1 << (pos % 8)
+			if not self._mmap[byte] & bit:
+				self._mmap[byte] |= bit
+				added = True
+
+		if added:
+			self._set_count(self.count + 1)
+
+	def __contains__(self, key: str) -> bool:
+		for pos in self._positions(key):
+			if not self._mmap[_HEADER.size + pos // 8] & (1 << (pos % 8)):
+				return False
+		return True
+
+	def flush(self):
+		self._mmap.flush()
+
+	def close(self):
+		self._mmap.close()
+		self._file.close()
@@ -1,30 +1,38 @@
 import os
+import sqlite3 as sql
 
 from art_dl.cache import CACHE_DB
 from art_dl.utils.db import DB
 
 
 class Cleanup:
-	KEY = 'filename'
+	""" Files which are being written, several files can be downloaded at once """
 
 	def __init__(self) -> None:
 		self.db = DB(CACHE_DB, 'cleanup')
 
 	def set(self, filename: str):
 		""" Remember file for cleaning """
-		self.db.insert(self.KEY, filename)
-
-	def forget(self):
-		self.db.delete(self.KEY)
-
-	def clean(self):
-		""" Perform cleanup """
-		filename = self.db.select(self.KEY)
-		if filename is None:
-			return
-		if os.path.exists(filename):
-			os.remove(filename)
-		self.forget()
+		self.db.insert(filename, filename)
+
+	def forget(self, filename: str):
+		self.db.delete(filename)
+
+	def clean(self, filename: str | None = None):
+		""" Perform cleanup of file, or of all remembered files """
+		rows: list[dict[str, str]] | list[sql.Row]
+		if filename is not None:
+			rows = [{
+				'key': filename,
+				'value': filename
+			}]
+		else:
+			rows = self.db.all()
+
+		for row in rows:
+			if os.path.exists(row['value']):
+				os.remove(row['value'])
+			self.db.delete(row['key'])
 
 
 cleanup = Cleanup()
@@ -0,0 +1,66 @@
+"""
+Compact encoding of json values stored in cache.
+
+Encoded value is a blob: format version (1 byte), compression (1 byte),
+size of uncompressed payload (4 bytes) and payload, which is compact utf-8 json.
+Values written by older versions are json strings, they are decoded as is.
+"""
+
+import zlib
+from json import dumps, loads
+from struct import Struct
+from typing import Any
+
+FORMAT_VERSION = 1
+# compress payloads bigger than this size in bytes
+COMPRESS_THRESHOLD = 256
+
+_HEADER = Struct('>BBI')
+
+
+class Compression:
+	none = 0
+	zlib = 1
+
+
+def encode(value: Any) -> bytes:
+	payload = dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+	size = len(payload)
+
+	compression = Compression.none
+	if size > COMPRESS_THRESHOLD:
+		compressed = zlib.compress(payload)
+		if len(compressed) < size:
+			payload = compressed
+			compression = Compression.zlib
+
+	return _HEADER.pack(FORMAT_VERSION, compression, size) + payload
+
+
+def decode(data: str | bytes) -> Any:
+	if isinstance(data, str):
+		# old format
+		return loads(data)
+
+	version, compression, _ = _HEADER.unpack_from(data)
+	if version != FORMAT_VERSION:
+		raise ValueError(f'Unknown cache format version: {version}')
+
+	payload = data[_HEADER.size:]
+	if compression == Compression.zlib:
+		payload = zlib.decompress(payload)
+	elif compression != Compression.none:
+		raise ValueError(f'Unknown cache compression: {compression}')
+
+	return loads(payload)
+
+
+def is_legacy(data: str | bytes) -> bool:
+	return isinstance(data, str)
+
+
+def decoded_size(data: str | bytes) -> int:
+	""" Approximate size of value after decoding """
+	if isinstance(data, str):
+		return len(data)
+	return _HEADER.unpack_from(data)[2]
@@ -14,7 +14,7 @@ class Config():
 		return self.db.select(key) or default
 
 	def set(self, key: str, value: str):
-		self.db.insert(key, value)
+		self.db.insert(key, value, replace=True)
 
 	def check_value(self, key: str):
 		value = self.get(key)
@@ -1,50 +1,142 @@
 import sqlite3 as sql
+import threading
+from asyncio import Task, create_task, get_running_loop
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from json import dumps, loads
-from typing import Any
+from time import time
+from typing import Any, Callable, Hashable, Mapping
+
+# site is a part of key before first ':', keys without it are not related to any site
+_SITE = "substr(key, 1, instr(key, ':') - 1)"
 
 
 class Queries:
 	init = '''CREATE TABLE IF NOT EXISTS {table} (
 		key TEXT NOT NULL PRIMARY KEY,
-		value TEXT
+		value TEXT,
+		updated_at INTEGER,
+		accessed_at INTEGER
 	)'''
-	insert = '''INSERT OR IGNORE INTO {table} (key, value) VALUES (:key, :value)'''
+	index = '''CREATE INDEX IF NOT EXISTS {table}_accessed_at ON {table} (accessed_at)'''
+	# rows created by older versions or imported from snapshot
+	backfill = '''UPDATE {table} SET accessed_at = coalesce(updated_at, 0)
+		WHERE accessed_at IS NULL'''
+	columns = '''PRAGMA table_info({table})'''
+	insert = '''INSERT OR IGNORE INTO {table} (key, value, updated_at, accessed_at)
+		VALUES (:key, :value, :now, :now)'''
+	replace = '''INSERT INTO {table} (key, value, updated_at, accessed_at)
+		VALUES (:key, :value, :now, :now)
+		ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at'''
 	select = '''SELECT value FROM {table} WHERE key = :key'''
+	count = '''SELECT count(*) FROM {table}'''
+	select_row = '''SELECT value, updated_at FROM {table} WHERE key = :key'''
+	all = '''SELECT key, value FROM {table}'''
+	touch = '''UPDATE {table} SET accessed_at = :now WHERE key = :key'''
+	update = '''UPDATE {table} SET value = :value WHERE key = :key'''
 	delete = '''DELETE FROM {table} WHERE key = :key'''
+	evict = '''DELETE FROM {table} WHERE key IN (
+		SELECT key FROM {table} WHERE instr(key, ':') > 0
+		ORDER BY accessed_at LIMIT :limit
+	)'''
+	stats = f'''SELECT {_SITE} AS site,
+		count(*) AS entries,
+		sum(length(key) + length(value)) AS size,
+		min(updated_at) AS oldest
+		FROM {{table}} WHERE instr(key, ':') > 0 GROUP BY site'''
 
 	def __init__(self, table: str) -> None:
-		for q in ['init', 'insert', 'select', 'delete']:
+		for q in [
+			'init',
+			'index',
+			'backfill',
+			'columns',
+			'insert',
+			'replace',
+			'select',
+			'count',
+			'select_row',
+			'all',
+			'touch',
+			'update',
+			'delete',
+			'evict',
+			'stats',
+		]:
 			self.__setattr__(q, self.__getattribute__(q).format(table=table))
 
+		self.table = table
+
+
+class Connection:
+	""" Base for sqlite wrappers, every thread uses its own connection """
+
+	def __init__(self, db_name: str) -> None:
+		self.db_name = db_name
+		self._local = threading.local()
+
+	def _local_connection(self) -> threading.local:
+		if getattr(self._local, 'conn', None) is None:
+			conn = sql.connect(self.db_name)
+			conn.row_factory = sql.Row
+			# with WAL it's safe and commits do not wait for fsync
+			conn.execute('PRAGMA synchronous = NORMAL')
+			self._local.conn = conn
+			self._local.cursor = conn.cursor()
+		return self._local
 
-class DB:
+	@property
+	def conn(self) -> sql.Connection:
+		return self._local_connection().conn
+
+	@property
+	def cursor(self) -> sql.Cursor:
+		return self._local_connection().cursor
+
+
+class DB(Connection):
 	""" Key-value sqlite wrapper """
 
 	def __init__(self, db_name: str, table: str) -> None:
-		self.db_name = db_name
+		super().__init__(db_name)
 		self.queries = Queries(table)
 		self.connect()
 
 	def connect(self):
-		self.conn = sql.connect(self.db_name)
-		self.conn.row_factory = sql.Row
-		self.cursor = self.conn.cursor()
-
+		# readers are not blocked by writer in another thread
+		self.conn.execute('PRAGMA journal_mode = WAL')
 		self.cursor.executescript(self.queries.init)
+		self._migrate()
+		self.cursor.executescript(self.queries.index)
+		# uses index, so it's fast when there is nothing to backfill
+		self.cursor.execute(self.queries.backfill)
 		self.conn.commit()
 
-	def insert(self, key: str, value: str | Any, *, as_json=False):
-		# if not as json value should be a string
-		if as_json is False and not isinstance(value, str):
-			raise TypeError('Value should be a string')
+	def _migrate(self):
+		""" Add columns missing in tables created by older versions """
+		columns = set(r['name'] for r in self.cursor.execute(self.queries.columns))
+		for column in ['updated_at', 'accessed_at']:
+			if column not in columns:
+				self.cursor.execute(f'ALTER TABLE {self.queries.table} ADD COLUMN {column} INTEGER')
+
+	def insert(self, key: str, value: str | Any, *, as_json=False, replace=False) -> bool:
+		"""
+		Pass `replace=True` to overwrite existing value.
+		Returns `False` if key already exists and value is not changed
+		"""
+		# if not as json value should be a string or already encoded bytes
+		if as_json is False and not isinstance(value, (str, bytes)):
+			raise TypeError('Value should be a string or bytes')
 
 		self.cursor.execute(
-			self.queries.insert, {
+			self.queries.replace if replace else self.queries.insert, {
 				'key': key,
 				'value': dumps(value) if as_json else value,
+				'now': int(time()),
 			}
 		)
 		self.conn.commit()
+		return self.cursor.rowcount > 0
 
 	def select(self, key: str, *, as_json=False):
 		res = self.cursor.execute(self.queries.select, {
@@ -55,6 +147,226 @@ class DB:
 		value = res['value']
 		return loads(value) if as_json else value
 
+	def select_row(self, key: str) -> sql.Row | None:
+		""" Select raw value with `updated_at` """
+		return self.cursor.execute(self.queries.select_row, {
+			'key': key
+		}).fetchone()
+
+	def touch(self, keys: list[str]):
+		""" Update `accessed_at` for keys """
+		now = int(time())
+		self.cursor.executemany(self.queries.touch, ({
+			'key': k,
+			'now': now
+		} for k in keys))
+		self.conn.commit()
+
+	def update(self, values: Mapping[str, str | bytes]):
+		""" Replace values without changing `updated_at` """
+		self.cursor.executemany(
+			self.queries.update, ({
+				'key': k,
+				'value': v
+			} for k, v in values.items())
+		)
+		self.conn.commit()
+
 	def delete(self, key: str):
-		self.cursor.execute(self.queries.delete, { 'key': key })
+		self.cursor.execute(self.queries.delete, {
+			'key': key
+		})
 		self.conn.commit()
+
+	def write_many(self, writes: dict[str, str | bytes | None]):
+		""" Replace values in one transaction, `None` value means delete """
+		now = int(time())
+		self.cursor.executemany(
+			self.queries.replace, ({
+				'key': k,
+				'value': v,
+				'now': now,
+			} for k, v in writes.items() if v is not None)
+		)
+		self.cursor.executemany(
+			self.queries.delete, ({
+				'key': k
+			} for k, v in writes.items() if v is None)
+		)
+		self.conn.commit()
+
+	def all(self) -> list[sql.Row]:
+		return self.cursor.execute(self.queries.all).fetchall()
+
+	def count(self) -> int:
+		return self.cursor.execute(self.queries.count).fetchone()[0]
+
+	def size(self) -> int:
+		""" Size of used pages of the whole database file in bytes """
+		page_count = self.cursor.execute('PRAGMA page_count').fetchone()[0]
+		freelist_count = self.cursor.execute('PRAGMA freelist_count').fetchone()[0]
+		page_size = self.cursor.execute('PRAGMA page_size').fetchone()[0]
+		return (page_count - freelist_count) * page_size
+
+	def evict(self, limit: int) -> int:
+		""" Delete `limit` least recently accessed site entries, returns count of deleted """
+		self.cursor.execute(self.queries.evict, {
+			'limit': limit
+		})
+		self.conn.commit()
+		return self.cursor.rowcount
+
+	def stats(self) -> list[sql.Row]:
+		""" Count entries and their size for every site """
+		return self.cursor.execute(self.queries.stats).fetchall()
+
+	def vacuum(self):
+		self.conn.execute('VACUUM')
+
+	@staticmethod
+	def _sites_filter(sites: list[str] | None) -> tuple[str, dict[str, str]]:
+		if not sites:
+			return '', {}
+		params = {
+			f'site{i}': s
+			for i, s in enumerate(sites)
+		}
+		return f' AND {_SITE} IN (' + ', '.join(':' + p for p in params) + ')', params
+
+	def export(
+		self, filename: str, sites: list[str] | None = None, since: int | None = None
+	) -> int:
+		"""
+		Copy site entries to another database, which can be merged with `merge`.
+		If snapshot already exists, entries are merged into it
+		"""
+		sites_filter, params = self._sites_filter(sites)
+		table = self.queries.table
+
+		self.conn.execute('ATTACH DATABASE :filename AS snapshot', {
+			'filename': filename
+		})
+		try:
+			self.cursor.executescript(Queries.init.format(table='snapshot.' + table))
+			self.cursor.execute(
+				f'''INSERT INTO snapshot.{table} (key, value, updated_at)
+				SELECT key, value, updated_at FROM main.{table}
+				WHERE instr(key, ':') > 0 AND coalesce(updated_at, 0) >= :since{sites_filter}
+				ON CONFLICT (key) DO UPDATE
+				SET value = excluded.value, updated_at = excluded.updated_at
+				WHERE excluded.updated_at > coalesce(snapshot.{table}.updated_at, 0)''', {
+					'since': since or 0,
+					**params
+				}
+			)
+			exported = self.cursor.rowcount
+			self.conn.commit()
+			self.conn.execute('VACUUM snapshot')
+		finally:
+			self.conn.execute('DETACH DATABASE snapshot')
+
+		return exported
+
+	def merge(self, filename: str, sites: list[str] | None = None) -> int:
+		""" Import entries from snapshot, entry with newest `updated_at` wins """
+		sites_filter, params = self._sites_filter(sites)
+		table = self.queries.table
+
+		self.conn.execute('ATTACH DATABASE :filename AS snapshot', {
+			'filename': filename
+		})
+		try:
+			self.cursor.execute(
+				f'''INSERT INTO main.{table} (key, value, updated_at, accessed_at)
+				SELECT key, value, updated_at, coalesce(updated_at, 0) FROM snapshot.{table}
+				WHERE instr(key, ':') > 0{sites_filter}
+				ON CONFLICT (key) DO UPDATE
+				SET value = excluded.value, updated_at = excluded.updated_at
+				WHERE coalesce(excluded.updated_at, 0) > coalesce(main.{table}.updated_at, 0)''', params
+			)
+			imported = self.cursor.rowcount
+			self.conn.commit()
+		finally:
+			self.conn.execute('DETACH DATABASE snapshot')
+
+		return imported
+
+
+class AsyncDB:
+	"""
+	Runs queries of `DB` in a dedicated thread, so event loop is not blocked by sqlite.
+	Writes are queued, all writes queued while previous commit is running are committed together.
+
+	`db` can be any `Connection` with `write_many` method, which accepts queued writes
+	"""
+
+	def __init__(self, db: Any) -> None:
+		self.db = db
+		self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+		# { '<key>': '<value>' }, `None` value means delete
+		self._writes: dict[Any, Any] = {}
+		self._writer: Task | None = None
+
+	async def run(self, func: Callable, *args) -> Any:
+		return await get_running_loop().run_in_executor(self._executor, partial(func, *args))
+
+	def submit(self, func: Callable, *args) -> Future:
+		""" Run in db thread without waiting """
+		return self._executor.submit(func, *args)
+
+	def pending_row(self, key: Hashable) -> tuple[bool, dict | None]:
+		""" Check if key is queued for writing, returns queued row like `DB.select_row` """
+		if key not in self._writes:
+			return False, None
+		if (value := self._writes[key]) is None:
+			return True, None
+		return True, {
+			'value': value,
+			'updated_at': int(time()),
+		}
+
+	async def select_row(self, key: str) -> sql.Row | dict | None:
+		is_pending, row = self.pending_row(key)
+		if is_pending:
+			return row
+		return await self.run(self.db.select_row, key)
+
+	def insert(self, key: Any, value: Any):
+		self._writes[key] = value
+		self._schedule()
+
+	def delete(self, key: Any):
+		self._writes[key] = None
+		self._schedule()
+
+	def _current_writer(self) -> Task | None:
+		""" Writer of previous event loop is dropped, it was stopped with its loop """
+		if self._writer is not None and self._writer.get_loop() is not get_running_loop():
+			self._writer = None
+		return self._writer
+
+	def _schedule(self):
+		if self._current_writer() is None:
+			self._writer = create_task(self._write())
+
+	async def _write(self):
+		try:
+			while len(self._writes) > 0:
+				writes, self._writes = self._writes, {}
+				await self.run(self.db.write_many, writes)
+		finally:
+			self._writer = None
+
+	async def flush(self):
+		""" Wait until all queued writes are committed """
+		if (writer := self._current_writer()) is not None:
+			await writer
+		# tasks submitted without waiting
+		await self.run(lambda: None)
+
+	def flush_sync(self):
+		""" Commit queued writes when event loop is not running """
+		self.submit(lambda: None).result()
+		if len(self._writes) > 0:
+			self.db.write_many(self._writes)
+			self._writes = {}
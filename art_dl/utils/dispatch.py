@@ -0,0 +1,30 @@
+"""
+Bus for passing urls between sites in one run, e.g. reddit post with imgur album
+is downloaded by imgur alongside other urls
+"""
+
+from typing import Awaitable, Callable
+
+Handler = Callable[[str], Awaitable[bool]]
+
+
+class Dispatch:
+	_handler: Handler | None = None
+
+	def connect(self, handler: Handler):
+		self._handler = handler
+
+	def disconnect(self):
+		self._handler = None
+
+	async def forward(self, url: str) -> bool:
+		"""
+		Queue url to site which supports it. Returns `False` if url can't be
+		processed in this run, then it should be retried later
+		"""
+		if self._handler is None:
+			return False
+		return await self._handler(url)
+
+
+dispatch = Dispatch()
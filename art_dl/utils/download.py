@@ -1,17 +1,89 @@
+from asyncio import get_running_loop
+from functools import partial
+from hashlib import sha256
+
 from aiofiles import open as aopen
 from aiohttp import ClientSession
 
+from art_dl.ledger import ledger
 from art_dl.utils.cleanup import cleanup
+from art_dl.utils.file_index import file_index
+from art_dl.utils.limit import host_limiter
+from art_dl.utils.singleflight import flight
+from art_dl.utils.url import normalize_url
+
+
+def _hash(data: bytes) -> str:
+	return sha256(data).hexdigest()
+
+
+async def _read(session: ClientSession, url: str) -> bytes:
+	async with host_limiter(url):
+		async with session.get(url, raise_for_status=True) as response:
+			return await response.read()
+
+
+async def read_binary(session: ClientSession, url: str, *, shared=True) -> bytes:
+	"""
+	Read file to memory. If request can be cancelled (e.g. hedged), `shared` should be `False`,
+	shared request is not cancelled with its caller
+	"""
+	if not shared:
+		return await _read(session, url)
+	# the same file can be requested by several callers at once, e.g. the same album from
+	# different posts, it's downloaded once
+	return await flight.do(normalize_url(url), partial(_read, session, url))
+
+
+async def save_binary(
+	data: bytes,
+	url: str,
+	filename: str,
+	*,
+	site: str | None = None,
+	site_id: str | None = None,
+	source: str | None = None,
+) -> int:
+	""" Save data of file read with `read_binary`, arguments are the same as `download_binary` """
+	cleanup.set(filename)
+	async with aopen(filename, 'wb') as file:
+		try:
+			await file.write(data)
+			cleanup.forget(filename)
+			file_index.add(filename)
+		except:
+			cleanup.clean(filename)
+			print('REMOVING EMPTY FILE')
+			raise
+
+	if site is not None and site_id is not None:
+		# big files are hashed in thread, so other downloads are not blocked
+		file_hash = await get_running_loop().run_in_executor(None, _hash, data)
+		ledger.record(
+			site,
+			site_id,
+			source=source,
+			url=url,
+			path=filename,
+			size=len(data),
+			hash=file_hash,
+		)
+	return len(data)
 
 
-async def download_binary(session: ClientSession, url: str, filename: str):
-	async with session.get(url, raise_for_status=True) as response:
-		cleanup.set(filename)
-		async with aopen(filename, 'wb') as file:
-			try:
-				await file.write(await response.read())
-				cleanup.forget()
-			except:
-				cleanup.clean()
-				print('REMOVING EMPTY FILE')
-				raise
+async def download_binary(
+	session: ClientSession,
+	url: str,
+	filename: str,
+	*,
+	site: str | None = None,
+	site_id: str | None = None,
+	source: str | None = None,
+) -> int:
+	"""
+	Download file, if `site` and `site_id` are passed, file is recorded in ledger.
+	`source` is the url passed to downloader, it's used to download file again.
+	Returns size of file
+	"""
+	data = await read_binary(session, url)
+	return await save_binary(data, url, filename, site=site, site_id=site_id, source=source)
@@ -0,0 +1,95 @@
+"""
+Index of files in download folders. Folder is scanned once, after that
+existence checks do not touch filesystem, downloaded files are added to index
+"""
+
+import os
+from collections import defaultdict
+from typing import Callable
+
+KeyFunc = Callable[[str], str]
+
+
+def name_full(name: str) -> str:
+	return name
+
+
+def name_stem(name: str) -> str:
+	""" `name.ext` -> `name` """
+	return os.path.splitext(name)[0]
+
+
+def name_prefix(name: str) -> str:
+	""" `<id> - <any text>.ext` -> `<id>` """
+	return name_stem(name).split(' - ', 1)[0]
+
+
+class FolderIndex:
+	""" Files of one folder grouped by key, e.g. by id of art """
+
+	def __init__(self, folder: str, key: KeyFunc) -> None:
+		self.key = key
+		self._files: defaultdict[str, set[str]] = defaultdict(set)
+
+		try:
+			with os.scandir(folder) as entries:
+				for entry in entries:
+					if entry.is_file():
+						self.add(entry.name)
+		except FileNotFoundError:
+			pass
+
+	def add(self, name: str):
+		self._files[self.key(name)].add(name)
+
+	def discard(self, name: str):
+		k = self.key(name)
+		if (names := self._files.get(k)) is not None:
+			names.discard(name)
+			if len(names) == 0:
+				del self._files[k]
+
+	def find(self, key: str) -> list[str]:
+		""" Names of files with given key """
+		return sorted(self._files.get(key, ()))
+
+	def __contains__(self, key: str) -> bool:
+		return key in self._files
+
+
+class FileIndex:
+	""" Indexes of all used folders """
+
+	def __init__(self) -> None:
+		# { '<folder>': { <key func>: FolderIndex } }
+		self._indexes: defaultdict[str, dict[KeyFunc, FolderIndex]] = defaultdict(dict)
+
+	@staticmethod
+	def _folder(folder: str) -> str:
+		return os.path.normpath(os.path.abspath(folder))
+
+	def get(self, folder: str, key: KeyFunc = name_full) -> FolderIndex:
+		indexes = self._indexes[self._folder(folder)]
+		if (index := indexes.get(key)) is None:
+			index = indexes[key] = FolderIndex(folder, key)
+		return index
+
+	def exists(self, filename: str) -> bool:
+		""" Replacement for `os.path.exists` """
+		folder, name = os.path.split(filename)
+		return name in self.get(folder)
+
+	def add(self, filename: str):
+		""" Should be called when file is created """
+		folder, name = os.path.split(filename)
+		for index in self._indexes.get(self._folder(folder), {}).values():
+			index.add(name)
+
+	def discard(self, filename: str):
+		""" Should be called when file is removed """
+		folder, name = os.path.split(filename)
+		for index in self._indexes.get(self._folder(folder), {}).values():
+			index.discard(name)
+
+
+file_index = FileIndex()
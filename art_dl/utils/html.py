@@ -0,0 +1,119 @@
+"""
+Extraction of values from html pages. Sites declare selectors, page is parsed
+in a separate thread, so parsing does not block downloads. Reading of streamed page
+is stopped when all selectors are found
+"""
+
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Any, AsyncIterator, Callable, NamedTuple
+
+from lxml import etree
+
+from art_dl.log import Logger
+
+logger = Logger(prefix=['html'])
+
+# parsers are not thread-safe, so all parsing is in one thread
+_executor = ThreadPoolExecutor(1, thread_name_prefix='html')
+
+
+class Selector(NamedTuple):
+	name: str
+	xpath: str
+	# all matches are returned, page is always parsed completely
+	many: bool = False
+	# applied to value, or to list of values if `many` is set
+	convert: Callable[[Any], Any] | None = None
+
+
+class _Parse:
+	""" State of parsing of one page, used only in parser thread """
+
+	def __init__(self, selectors: list[Selector]) -> None:
+		self.selectors = selectors
+		# no early termination if all matches are needed
+		self.can_stop = not any(s.many for s in selectors)
+		self.parser = etree.HTMLPullParser(events=('start', ))
+		self.tree: Any = None
+		self.result: dict[str, Any] = {}
+		self.time = 0.0
+
+	def _select(self, tree: Any, final: bool):
+		for s in self.selectors:
+			if s.name in self.result or (s.many and not final):
+				continue
+
+			values = tree.xpath(s.xpath)
+			if s.many:
+				self.result[s.name] = s.convert(values) if s.convert else values
+			elif len(values) > 0:
+				self.result[s.name] = s.convert(values[0]) if s.convert else values[0]
+
+	def feed(self, data: bytes | str) -> bool:
+		""" Returns `True` when all selectors are found """
+		start = perf_counter()
+		self.parser.feed(data)
+		for _, element in self.parser.read_events():
+			if self.tree is None and element is not None:
+				self.tree = element.getroottree()
+
+		done = False
+		if self.can_stop and self.tree is not None:
+			self._select(self.tree, False)
+			done = len(self.result) == len(self.selectors)
+
+		self.time += perf_counter() - start
+		return done
+
+	def close(self) -> dict[str, Any]:
+		""" Selectors which are not found are `None` """
+		start = perf_counter()
+		try:
+			root = self.parser.close()
+		except etree.XMLSyntaxError:
+			# empty page
+			root = None
+		if root is not None:
+			self._select(root, True)
+
+		self.time += perf_counter() - start
+		return {
+			s.name: self.result.get(s.name)
+			for s in self.selectors
+		}
+
+
+class Extractor:
+
+	def __init__(self, name: str, selectors: list[Selector]) -> None:
+		self.name = name
+		self.selectors = selectors
+
+	@staticmethod
+	async def _run(func: Callable, *args) -> Any:
+		return await get_running_loop().run_in_executor(_executor, func, *args)
+
+	def _log(self, parse: _Parse, size: int):
+		logger.verbose(self.name, f'parsed {size} bytes in {parse.time * 1000:.1f} ms')
+
+	async def extract(self, data: bytes | str) -> dict[str, Any]:
+		parse = _Parse(self.selectors)
+		await self._run(parse.feed, data)
+		result = await self._run(parse.close)
+		self._log(parse, len(data))
+		return result
+
+	async def extract_stream(self, chunks: AsyncIterator[bytes]) -> dict[str, Any]:
+		""" Rest of chunks is not read after all selectors are found """
+		parse = _Parse(self.selectors)
+		size = 0
+		async for chunk in chunks:
+			size += len(chunk)
+			if await self._run(parse.feed, chunk):
+				break
+
+		result = await self._run(parse.close)
+		self._log(parse, size)
+		return result
@@ -0,0 +1,152 @@
+"""
+Pool of mirrors of one site (e.g. nitter instances). Requests go to the fastest healthy
+instance; if it's slower than usual, the same request is sent to the next one
+and the first response is used
+"""
+
+from asyncio import FIRST_COMPLETED, CancelledError, Task, create_task, wait
+from collections import defaultdict, deque
+from functools import partial
+from time import perf_counter
+from typing import Any, Awaitable, Callable, TypeVar
+
+T = TypeVar('T')
+
+# number of last requests used for latency
+LATENCY_WINDOW = 20
+# latencies of different kinds of requests (e.g. pages and images) are not mixed
+DEFAULT_KIND = 'page'
+# p90 is not calculated with less samples, so requests are not hedged
+MIN_SAMPLES = 5
+# latency of instance without requests, in seconds
+DEFAULT_LATENCY = 2.0
+# instance is unhealthy after this number of failures in a row
+MAX_FAILURES = 3
+# score is multiplied by (1 + error rate * ERROR_PENALTY)
+ERROR_PENALTY = 4
+
+
+class Instance:
+
+	def __init__(self, url: str) -> None:
+		self.url = url
+		# { '<kind>': deque([<latency>, ...]) }
+		self.latencies: defaultdict[str, deque[float]] = defaultdict(
+			partial(deque, maxlen=LATENCY_WINDOW)
+		)
+		self.requests = 0
+		self.errors = 0
+		self.failures_in_row = 0
+
+	def success(self, kind: str, latency: float):
+		self.latencies[kind].append(latency)
+		self.requests += 1
+		self.failures_in_row = 0
+
+	def failure(self):
+		self.requests += 1
+		self.errors += 1
+		self.failures_in_row += 1
+
+	@property
+	def healthy(self) -> bool:
+		return self.failures_in_row < MAX_FAILURES
+
+	def score(self, kind: str) -> float:
+		""" Lower is better """
+		latency = DEFAULT_LATENCY
+		if len(latencies := self.latencies[kind]) > 0:
+			latency = sum(latencies) / len(latencies)
+		error_rate = self.errors / self.requests if self.requests > 0 else 0
+		return latency * (1 + error_rate * ERROR_PENALTY)
+
+	def p90(self, kind: str) -> float | None:
+		if len(self.latencies[kind]) < MIN_SAMPLES:
+			return None
+		latencies = sorted(self.latencies[kind])
+		return latencies[int(0.9 * (len(latencies) - 1))]
+
+
+class InstancePool:
+	"""
+	Should be created for each session. Number of instances used for one request
+	is limited by `failover_budget`
+	"""
+
+	def __init__(self, urls: list[str] | tuple[str, ...], failover_budget=3) -> None:
+		self.instances = [Instance(u) for u in urls]
+		self.failover_budget = failover_budget
+
+	def ranked(self, kind: str = DEFAULT_KIND) -> list[Instance]:
+		""" Healthy instances sorted by score, then unhealthy """
+		return sorted(self.instances, key=lambda i: (not i.healthy, i.score(kind)))
+
+	@staticmethod
+	async def _timed(instance: Instance, kind: str, func: Callable[[str], Awaitable[T]]) -> T:
+		start = perf_counter()
+		try:
+			result = await func(instance.url)
+		except CancelledError:
+			raise
+		except Exception:
+			instance.failure()
+			raise
+
+		instance.success(kind, perf_counter() - start)
+		return result
+
+	async def request(self, func: Callable[[str], Awaitable[T]], kind: str = DEFAULT_KIND) -> T:
+		"""
+		Call `func` with base url of instance. If it fails, next instance is used,
+		if it's slower than p90 of instance, request is duplicated to next instance.
+		Losing request is cancelled, so `func` should not share its work with other callers
+		"""
+		instances = self.ranked(kind)[:self.failover_budget]
+		tasks: dict[Task, Instance] = {}
+		pending: set[Task] = set()
+		error: BaseException | None = None
+
+		def start():
+			instance = instances[len(tasks)]
+			task = create_task(self._timed(instance, kind, func))
+			tasks[task] = instance
+			pending.add(task)
+
+		start()
+		try:
+			while len(pending) > 0:
+				timeout = None
+				if len(pending) == 1 and len(tasks) < len(instances):
+					timeout = tasks[next(iter(pending))].p90(kind)
+
+				done, _ = await wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+				if len(done) == 0:
+					# slower than usual, hedge request
+					start()
+					continue
+
+				for task in done:
+					pending.discard(task)
+					if (error := task.exception()) is None:
+						return task.result()
+
+				if len(pending) == 0 and len(tasks) < len(instances):
+					# failover
+					start()
+		finally:
+			for task in pending:
+				task.cancel()
+
+		raise error  # type: ignore
+
+	def stats(self) -> list[tuple[str, dict[str, Any], int, int]]:
+		""" Url, p90 of each kind of requests, number of requests and errors for each instance """
+		return [(
+			i.url,
+			{
+				k: i.p90(k)
+				for k in i.latencies
+			},
+			i.requests,
+			i.errors,
+		) for i in self.instances]
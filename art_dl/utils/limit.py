@@ -0,0 +1,76 @@
+"""
+Limits of concurrent requests and of requests rate
+"""
+
+from asyncio import AbstractEventLoop, Lock, Semaphore, get_running_loop, sleep
+from collections import deque
+from time import monotonic
+from urllib.parse import urlparse
+
+from art_dl.utils.config import config
+
+# max number of concurrent downloads from one host,
+# can be changed with "--action config:download_limit"
+DEFAULT_HOST_LIMIT = 4
+
+
+def _limit_config() -> int:
+	try:
+		return max(1, int(config.get('download_limit') or DEFAULT_HOST_LIMIT))
+	except ValueError:
+		return DEFAULT_HOST_LIMIT
+
+
+class HostLimiter:
+	"""
+	Semaphore per host, use as `async with host_limiter(url): ...`.
+	Semaphores are recreated for each event loop, because every retry round has its own loop
+	"""
+
+	def __init__(self, limit: int) -> None:
+		self.limit = limit
+		self._semaphores: dict[str, Semaphore] = {}
+		self._loop: AbstractEventLoop | None = None
+
+	def __call__(self, url: str) -> Semaphore:
+		if (loop := get_running_loop()) is not self._loop:
+			self._loop = loop
+			self._semaphores = {}
+
+		host = urlparse(url).netloc
+		if (semaphore := self._semaphores.get(host)) is None:
+			semaphore = self._semaphores[host] = Semaphore(self.limit)
+		return semaphore
+
+
+class RateLimiter:
+	"""
+	Allows at most `rate` calls in `period` seconds (sliding window),
+	call `await limiter.wait()` before each request. Calls are counted across event loops
+	"""
+
+	def __init__(self, rate: int, period: float = 60) -> None:
+		self.rate = rate
+		self.period = period
+		self._calls: deque[float] = deque()
+		self._lock = Lock()
+		self._loop: AbstractEventLoop | None = None
+
+	async def wait(self):
+		if (loop := get_running_loop()) is not self._loop:
+			# lock can't be used in another loop
+			self._loop = loop
+			self._lock = Lock()
+
+		async with self._lock:
+			while True:
+				now = monotonic()
+				while len(self._calls) > 0 and self._calls[0] <= now - self.period:
+					self._calls.popleft()
+				if len(self._calls) < self.rate:
+					break
+				await sleep(self._calls[0] + self.period - now)
+			self._calls.append(now)
+
+
+host_limiter = HostLimiter(_limit_config())
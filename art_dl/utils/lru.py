@@ -0,0 +1,58 @@
+from collections import Counter, OrderedDict
+from typing import Any, Hashable
+
+
+class LRU:
+	""" In-memory least recently used storage, bounded by summary size of values """
+
+	def __init__(self, limit: int) -> None:
+		# size is estimated by caller, usually it's length of serialized value
+		self.limit = limit
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self._data: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+
+	def __contains__(self, key: Hashable) -> bool:
+		return key in self._data
+
+	def __len__(self) -> int:
+		return len(self._data)
+
+	def get(self, key: Hashable, default=None):
+		if key not in self._data:
+			self.misses += 1
+			return default
+
+		self.hits += 1
+		self._data.move_to_end(key)
+		return self._data[key][0]
+
+	def set(self, key: Hashable, value: Any, size: int):
+		self.pop(key)
+		if size > self.limit:
+			# do not evict everything for one huge value
+			return
+
+		self._data[key] = (value, size)
+		self.size += size
+
+		while self.size > self.limit:
+			_, (_, old_size) = self._data.popitem(last=False)
+			self.size -= old_size
+
+	def pop(self, key: Hashable):
+		if (item := self._data.pop(key, None)) is not None:
+			self.size -= item[1]
+
+	def clear(self):
+		self._data.clear()
+		self.size = 0
+
+	def stats(self) -> Counter:
+		return Counter(
+			hits=self.hits,
+			misses=self.misses,
+			entries=len(self._data),
+			size=self.size,
+		)
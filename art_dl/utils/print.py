@@ -3,3 +3,7 @@ from typing import Counter
 
 def counter2str(c: Counter):
 	return ', '.join(f'{i}: {v}' for i, v in c.items())
+
+
+def format_size(size: int | float) -> str:
+	return f'{size / 1024 / 1024:.1f} MiB'
@@ -9,14 +9,22 @@ class Retry:
 	def get(self) -> list[str] | None:
 		return cache.select(None, self.KEY, as_json=True)
 
-	def add(self, to_retry: list[str] | str):
-		urls = self.get() or []
+	@staticmethod
+	def _extend(urls: list[str], to_retry: list[str] | str) -> list[str]:
 		if isinstance(to_retry, list):
 			urls.extend(to_retry)
 		else:
 			urls.append(to_retry)
+		return urls
+
+	def add(self, to_retry: list[str] | str):
+		urls = self.get() or []
+		cache.insert(None, self.KEY, self._extend(urls, to_retry), as_json=True)
 
-		cache.insert(None, self.KEY, urls, as_json=True)
+	async def aadd(self, to_retry: list[str] | str):
+		""" Like `add`, but does not block event loop, write to database is queued """
+		urls = await cache.aselect(None, self.KEY, as_json=True) or []
+		await cache.ainsert(None, self.KEY, self._extend(urls, to_retry), as_json=True)
 
 	def clear(self, *, force=False):
 		if force:
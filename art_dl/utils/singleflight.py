@@ -0,0 +1,34 @@
+"""
+Coalescing of identical requests: while request is in flight,
+other callers with the same key wait for its result instead of making new request
+"""
+
+from asyncio import Task, create_task, shield
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+
+	def __init__(self) -> None:
+		self._calls: dict[Hashable, Task[Any]] = {}
+
+	async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+		"""
+		Call `func` or wait for result of call with the same key.
+		Exception is raised for all callers
+		"""
+		if (task := self._calls.get(key)) is None:
+			task = create_task(func())  # type: ignore
+			self._calls[key] = task
+			task.add_done_callback(lambda _: self._calls.pop(key, None))
+
+		# cancelling of one caller should not cancel request for others
+		return await shield(task)
+
+	def __contains__(self, key: Hashable) -> bool:
+		return key in self._calls
+
+
+flight = SingleFlight()
@@ -1,3 +1,6 @@
+from urllib.parse import urlparse
+
+
 def parse_range(rng: str) -> list[int] | None:
 	"""
 	Convert range like `1-3,5` to `[1, 2, 3, 5]`.
@@ -17,3 +20,37 @@ def parse_range(rng: str) -> list[int] | None:
 			result.add(int(p))
 
 	return sorted(list(result))
+
+
+def format_range(numbers: list[int]) -> str:
+	"""
+	Convert numbers like `[1, 2, 3, 5]` to range `1-3,5`,
+	reverse of `parse_range`
+	"""
+	parts: list[str] = []
+	numbers = sorted(set(numbers))
+	i = 0
+	while i < len(numbers):
+		start = numbers[i]
+		while i + 1 < len(numbers) and numbers[i + 1] == numbers[i] + 1:
+			i += 1
+		end = numbers[i]
+		parts.append(str(start) if start == end else f'{start}-{end}')
+		i += 1
+
+	return ','.join(parts)
+
+
+def normalize_url(url: str) -> str:
+	"""
+	Remove parts of url which do not change content:
+	scheme, `www.` and trailing slash. Query and fragment are kept
+	"""
+	parsed = urlparse(url.strip())
+	netloc = parsed.netloc.lower().removeprefix('www.')
+	result = netloc + parsed.path.rstrip('/')
+	if parsed.query:
+		result += '?' + parsed.query
+	if parsed.fragment:
+		result += '#' + parsed.fragment
+	return result